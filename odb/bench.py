@@ -0,0 +1,79 @@
+""" startup benchmark of the command line, to keep ``odb info`` fast enough
+for shell prompts and status bars::
+
+    $ python -m odb.bench --runs 20
+
+It creates a temporary database, then measures in fresh interpreters the
+import of the command line and a complete ``odb info``, then in process the
+batched metadata read compared with one connection and query per key.
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from .odb import ODB
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _run(code, runs, env=None, args=()):
+    """ median duration of a python snippet in a new interpreter
+    """
+    durations = []
+    for _ in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable, '-c', code] + list(args), env=env,
+                              stdout=open(os.devnull, 'w'))
+        durations.append(time.time() - start)
+    return _median(durations)
+
+
+def _call(function, runs):
+    durations = []
+    for _ in range(runs):
+        start = time.time()
+        function()
+        durations.append(time.time() - start)
+    return _median(durations)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='python -m odb.bench', description=__doc__.split('::')[0])
+    parser.add_argument('--runs', '-n', type=int, default=10, help='runs of each measure')
+    args = parser.parse_args()
+
+    db = 'odbbench-' + time.strftime('%Y%m%d%H%M%S')
+    odb = ODB(db)
+    odb._createdb()
+    home = tempfile.mkdtemp()
+    try:
+        odb.init()
+        odb.tag('bench')
+        with open(os.path.join(home, '.anybox.pg.odoo'), 'w') as conf:
+            conf.write('[database]\ndbname = %s\n' % db)
+        env = dict(os.environ, HOME=home)
+        results = [
+            ('python startup', _run('pass', args.runs)),
+            ('import odb.cli', _run('import odb.cli', args.runs)),
+            ('odb info', _run('import sys; sys.argv[0] = "odb"; from odb.cli import main; main()',
+                              args.runs, env=env, args=['info'])),
+            ('metadata: one query', _call(odb.metadata, args.runs)),
+            ('metadata: one query per key',
+             _call(lambda: (odb.revision(), odb.parent(), odb.get('tag')), args.runs)),
+        ]
+    finally:
+        shutil.rmtree(home)
+        odb.dropdb()
+    for name, duration in results:
+        print('%-30s %8.1f ms' % (name, duration * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+""" per-table checksums of a database, used to detect tampered snapshots
+
+The checksum of a table is an order-independent sum of the md5 of its rows,
+so it can be compared between a snapshot and any copy of it.
+Rows of the odb metadata are ignored, because they are the revision itself.
+
+The quick verification only rechecks the tables with write statistics, or
+whose file changed since the commit, which happens with TRUNCATE. It checks
+everything if the statistics were reset meanwhile.
+"""
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+from .reset import STATS_RESET
+
+TABLE = ("SELECT count(*), coalesce(sum(('x' || substr(md5(t::text), 1, 15))"
+         "::bit(60)::bigint), 0) FROM \"%s\".\"%s\" t")
+METADATA = " WHERE t.key NOT LIKE 'odb.%%'"
+SEQUENCE = "SELECT last_value, is_called FROM \"%s\".\"%s\""
+FILENODES = ("SELECT n.nspname || '.' || c.relname, c.relfilenode FROM pg_class c "
+             "JOIN pg_namespace n ON n.oid = c.relnamespace WHERE c.relkind = 'r' "
+             "AND n.nspname NOT IN ('pg_catalog', 'information_schema') "
+             "AND n.nspname NOT LIKE 'pg_toast%'")
+
+
+def _checksum(cr, schema, name, sequence):
+    if sequence:
+        cr.execute(SEQUENCE % (schema, name))
+    elif (schema, name) == ('public', 'ir_config_parameter'):
+        cr.execute(TABLE % (schema, name) + METADATA)
+    else:
+        cr.execute(TABLE % (schema, name))
+    value = ':'.join(str(v) for v in cr.fetchone())
+    return hashlib.md5(value.encode('utf-8')).hexdigest()[:16]
+
+
+def checksums(odb, db, names=None, jobs=4):
+    """ return the checksums of the tables and sequences of ``db``,
+    or only of the given ``names``, as a {'schema.name': checksum} dict
+    """
+    with odb.connect(db) as cn, cn.cursor() as cr:
+        sequences = set(odb._tables(cr, ('S',)))
+        relations = odb._tables(cr, ('r', 'S'))
+    if names is not None:
+        relations = [r for r in relations if '.'.join(r) in names]
+    chunks = [relations[i::max(jobs, 1)] for i in range(max(jobs, 1))]
+
+    def compute(chunk):
+        result = {}
+        cn = odb.connect(db)
+        try:
+            with cn.cursor() as cr:
+                for relation in chunk:
+                    result['.'.join(relation)] = _checksum(
+                        cr, relation[0], relation[1], relation in sequences)
+        finally:
+            cn.close()
+        return result
+
+    result = {}
+    pool = ThreadPool(len(chunks))
+    try:
+        for chunk_result in pool.map(compute, [c for c in chunks if c]):
+            result.update(chunk_result)
+    finally:
+        pool.close()
+        pool.join()
+    return result
+
+
+def filenodes(odb, db):
+    """ return the file of each table of ``db`` and the reset date of its
+    statistics, which the quick verification compares with the current ones
+    """
+    with odb.connect(db) as cn, cn.cursor() as cr:
+        cr.execute(FILENODES)
+        tables = dict(cr.fetchall())
+        cr.execute(STATS_RESET)
+        return {'tables': tables, 'stats_reset': cr.fetchone()[0]}
+
+
+def modified(odb, db):
+    """ return the tables with write activity in the statistics of ``db``.
+    A fresh clone starts with empty statistics, so this is a cheap way to
+    only recheck the tables which may have changed. It misses the changes
+    hidden by a reset of the statistics or done with TRUNCATE, see filenodes().
+    """
+    with odb.connect(db) as cn, cn.cursor() as cr:
+        cr.execute("SELECT schemaname, relname FROM pg_stat_user_tables "
+                   "WHERE n_tup_ins + n_tup_upd + n_tup_del > 0")
+        return set('.'.join(r) for r in cr.fetchall())
+
+
+def verify(odb, db, recorded, quick=False, jobs=4, recorded_filenodes=None):
+    """ return the sorted list of tables of ``db`` whose checksum differs
+    from the ``recorded`` ones, including the created and dropped tables.
+    The ``quick`` verification needs the filenodes() recorded at the same time,
+    otherwise everything is checked.
+    """
+    with odb.connect(db) as cn, cn.cursor() as cr:
+        sequences = set('.'.join(r) for r in odb._tables(cr, ('S',)))
+        names = set('.'.join(r) for r in odb._tables(cr, ('r', 'S')))
+    tampered = names ^ set(recorded)
+    names &= set(recorded)
+    current = filenodes(odb, db) if quick and recorded_filenodes else None
+    if current and current['stats_reset'] == recorded_filenodes['stats_reset']:
+        changed = set(t for t in current['tables']
+                      if current['tables'][t] != recorded_filenodes['tables'].get(t))
+        names &= (modified(odb, db) | changed | sequences
+                  | set(['public.ir_config_parameter']))
+    current = checksums(odb, db, names, jobs=jobs)
+    tampered.update(n for n in current if current[n] != recorded[n])
+    return sorted(tampered)
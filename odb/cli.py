@@ -10,14 +10,38 @@ try:
 except ImportError:  # Python3.1
     from backports import configparser
 
-from .odb import ODB, TagExists, NoTemplate
+# the modules of odb are imported by the sub-commands, to start faster
 CONF = os.path.expanduser('~/.anybox.pg.odoo')
+METRICS = os.path.expanduser('~/.anybox.pg.odoo.metrics')
+STORE = os.path.expanduser('~/.anybox.pg.odoo.store')
+JOBS = os.path.expanduser('~/.anybox.pg.odoo.jobs')
 
 get_input = input
 if sys.version[0] == '2':
     get_input = raw_input
 
 
+def parse_size(size):
+    """ convert a size such as 500M or 5G to bytes
+    """
+    units = 'KMGT'
+    if size and size[-1].upper() in units:
+        return int(float(size[:-1]) * 1024 ** (units.index(size[-1].upper()) + 1))
+    return int(size)
+
+
+def format_size(size):
+    """ convert bytes to a human readable size
+    """
+    if size < 1024:
+        return '%s B' % size
+    for unit in ('kB', 'MB', 'GB', 'TB'):
+        size /= 1024.0
+        if size < 1024:
+            break
+    return '%.1f %s' % (size, unit)
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog="odb",
@@ -33,15 +57,44 @@ def main():
     parser_init.add_argument('--port', '-P', metavar='Port', help='The DB port to connect on')
     parser_commit = subparsers.add_parser('commit', help='Save the current db in a new revision')
     parser_commit.add_argument('-m', '--message', nargs='?', help='Commit message')
+    parser_commit.add_argument('--no-checksum', action='store_true',
+                               help='Do not record the checksums used by odb verify')
+    parser_commit.add_argument('--compact', '-c', action='store_true',
+                               help='Truncate the transient tables, vacuum and freeze the db '
+                                    'before the commit')
+    parser_commit.add_argument('--truncate', '-t', action='append', metavar='TABLE',
+                               help='transient table to truncate with --compact (default: '
+                                    'the "truncate" option of the [compact] section in %s)' % CONF)
+    parser_commit.add_argument('--store', '-s', action='store_true',
+                               help='Save the revision in the deduplicated store (the "path" '
+                                    'option of the [store] section, default: %s) '
+                                    'instead of a database' % STORE)
+    parser_commit.add_argument('--async', '-a', action='store_true', dest='background',
+                               help='Return immediately and make the snapshot in a background '
+                                    'worker (see odb jobs)')
     parser_info = subparsers.add_parser('info', help='Display the revision of the current db')
     parser_revert = subparsers.add_parser(
         'revert', help='Drop the current db and clone from a previous revision')
     parser_revert.add_argument('revision', nargs='?', help='revision to revert to')
+    parser_revert.add_argument('--fast', '-f', action='store_true',
+                               help='only restore the tables modified since the last commit or '
+                                    'revert, unless the schema changed')
     parser_log = subparsers.add_parser('log', help='List all available revisions')
     parser_log.add_argument('--limit', '-l', type=int, metavar='NUM',
                             help="limit number of changes displayed")
     parser_log.add_argument('--graph', '-g', action='store_true',
                             help='display a left graph to highlight history')
+    parser_log.add_argument('--since', metavar='DATE',
+                            help='only revisions committed since this UTC date (YYYY-MM-DD)')
+    parser_log.add_argument('--until', metavar='DATE',
+                            help='only revisions committed before this UTC date (YYYY-MM-DD)')
+    parser_log.add_argument('--slower-than', type=float, metavar='SECONDS',
+                            help='only revisions whose clone lasted at least SECONDS')
+    parser_log.add_argument('--larger-than', type=parse_size, metavar='SIZE',
+                            help='only revisions of at least SIZE (bytes, or with a '
+                                 'k, M, G or T suffix)')
+    parser_log.add_argument('--committer', metavar='USER',
+                            help='only revisions committed by USER')
     parser_purge = subparsers.add_parser('purge', help="Destroy revisions")
     parser_purge.add_argument('what', choices=['all', 'keeptags'],
                               help='all: destroy all revisions except the current db')
@@ -51,8 +104,43 @@ def main():
     parser_tag.add_argument('-d', '--delete', action='store_true', help='Delete tag')
     parser_tag.add_argument('tag', help='Tag')
     parser_tag.add_argument('revision', metavar='revision', nargs='?', help='Revision')
+    parser_verify = subparsers.add_parser(
+        'verify', help='Check that revisions have not been modified since commit')
+    parser_verify.add_argument('revision', nargs='?', help='revision or tag (default: all)')
+    parser_verify.add_argument('--quick', '-q', action='store_true',
+                               help='only recheck the tables with write statistics')
+    parser_verify.add_argument('--jobs', '-j', type=int, default=4, metavar='NUM',
+                               help='number of tables checked in parallel')
+    parser_metrics = subparsers.add_parser(
+        'metrics', help='Export the metrics of the snapshots and operations (OpenMetrics)')
+    parser_metrics.add_argument('--output', '-o', metavar='FILE',
+                                help='atomically write to FILE, for the textfile collector '
+                                     'of the node exporter (default: stdout)')
+    parser_jobs = subparsers.add_parser('jobs', help='List the background commits')
+    parser_jobs.add_argument('--wait', '-w', action='store_true',
+                             help='wait for the pending commits')
+    parser_jobs.add_argument('--clear', action='store_true',
+                             help='forget the finished and failed commits')
+    parser_push = subparsers.add_parser('push', help='Copy a revision to another cluster')
+    parser_pull = subparsers.add_parser('pull', help='Copy a revision from another cluster')
+    for subparser in parser_push, parser_pull:
+        subparser.add_argument('revision', nargs='?',
+                               help='revision or tag to copy (default: the parent)')
+        subparser.add_argument('--db', '-d', metavar='db',
+                               help='remote database name (default: the same)')
+        subparser.add_argument('--user', '-u', metavar='Username', help='remote db user')
+        subparser.add_argument('--password', '-p', metavar='pass', help='remote db user password')
+        subparser.add_argument('--host', '-H', metavar='Hostname', help='The remote DB hostname')
+        subparser.add_argument('--port', '-P', metavar='Port', help='The remote DB port')
+        subparser.add_argument('--jobs', '-j', type=int, default=4, metavar='NUM',
+                               help='number of tables transferred in parallel')
+        subparser.add_argument('--compress', '-Z', type=int, default=6, metavar='0-9',
+                               help='compression level of the schema and data')
 
-    def odb_from_conf_file(conf_file):
+    def odb_from_conf_file(conf_file, light=False):
+        """ ``light`` is an ODB without metrics and store, faster to load
+        """
+        from .odb import ODB
         config = configparser.ConfigParser()
         config.read(conf_file)
         dbname = config.get('database', 'dbname')
@@ -60,9 +148,28 @@ def main():
         password = config.get('database', 'password', fallback=None)
         host = config.get('database', 'host', fallback=None)
         port = config.get('database', 'port', fallback=None)
-        return ODB(dbname, user, password=password, host=host, port=port)
+        if light:
+            return ODB(dbname, user, password=password, host=host, port=port)
+        from .jobs import Queue
+        from .metrics import Metrics
+        from .store import Store
+        store = Store(config.get('store', 'path', fallback=STORE),
+                      jobs=config.getint('store', 'jobs', fallback=4))
+        scheduler = None
+        if config.has_section('scheduler'):
+            from .scheduler import Scheduler
+            lag = config.get('scheduler', 'max_replication_lag', fallback=None)
+            scheduler = Scheduler(
+                config.getint('scheduler', 'max_clones', fallback=2),
+                checkpoint_backoff=config.getboolean('scheduler', 'checkpoint_backoff',
+                                                     fallback=False),
+                max_replication_lag=float(lag) if lag else None,
+                max_backoff=config.getfloat('scheduler', 'max_backoff', fallback=300))
+        return ODB(dbname, user, password=password, host=host, port=port,
+                   metrics=Metrics(METRICS), store=store, queue=Queue(JOBS), scheduler=scheduler)
 
     def init(args):
+        from .odb import ODB
         odb = ODB(args.db[0], user=args.user, password=args.password,
                   host=args.host, port=args.port)
         odb.init()
@@ -82,25 +189,44 @@ def main():
         print('Now revision %s' % odb.revision())
 
     def commit(args):
+        from .odb import ReferencedTable, NotOwner, UnknownTable
         odb = odb_from_conf_file(CONF)
-        odb.commit(msg=args.message)
-        print('Now revision %s' % odb.revision())
+        truncate = args.truncate
+        if truncate is None:
+            config = configparser.ConfigParser()
+            config.read(CONF)
+            truncate = config.get('compact', 'truncate', fallback='').split(',')
+        try:
+            revision = odb.commit(msg=args.message, checksum=not args.no_checksum,
+                                  compact=args.compact or bool(args.truncate),
+                                  truncate=[t.strip() for t in truncate if t.strip()],
+                                  store=args.store, background=args.background)
+        except (ReferencedTable, NotOwner, UnknownTable) as e:
+            print(e.args[0])
+            return
+        if args.background:  # the db is fenced
+            print('Committing revision %s in the background' % revision)
+        print('Now revision %s' % (revision + 1))
 
     def revert(args):
+        from .odb import NoTemplate
         odb = odb_from_conf_file(CONF)
         try:
             if args.revision and args.revision.isdigit():
-                odb.revert(parent=args.revision)
+                tables = odb.revert(parent=args.revision, fast=args.fast)
             elif args.revision and args.revision.isalnum():
-                odb.revert(tag=args.revision)
+                tables = odb.revert(tag=args.revision, fast=args.fast)
             else:
-                odb.revert()
+                tables = odb.revert(fast=args.fast)
+            if tables is not None:
+                print('Restored %s modified tables' % len(tables))
             print('Reverted to parent %s, now at revision %s' % (odb.parent(), odb.revision()))
         except NoTemplate as e:
             print(e.args[0])
 
     def info(args):
-        odb = odb_from_conf_file(CONF)
+        odb = odb_from_conf_file(CONF, light=True)
+        metadata = odb.metadata()
         print('database: %s' % odb.db)
         if odb.user:
             print('user: %s' % odb.user)
@@ -108,24 +234,41 @@ def main():
             print('host: %s' % odb.host)
         if odb.port:
             print('port: %s' % odb.port)
-        print('revision : %s (parent: %s)' % (odb.revision(), odb.parent()))
-        tag = odb.get('tag')
-        if tag:
-            print('tag: %s' % tag)
+        print('revision : %(revision)s (parent: %(parent)s)' % metadata)
+        if metadata.get('tag'):
+            print('tag: %s' % metadata['tag'])
 
     def log(args):
         odb = odb_from_conf_file(CONF)
         output = []
+        filters = {'since': args.since, 'until': args.until, 'min_duration': args.slower_than,
+                   'min_size': args.larger_than, 'committer': args.committer}
         if args.graph:
-            output = odb.glog(args.limit)
+            output = odb.glog(args.limit, **filters)
         else:
-            for logitem in odb.log(args.limit):
+            for logitem in odb.log(args.limit, **filters):
                 output.append('%(db)s:\n\trevision: %(revision)s\n\t'
                               'parent: %(parent)s' % logitem)
+                if 'status' in logitem:
+                    output.append('\tstatus: %s' % logitem['status'])
+                if 'error' in logitem:
+                    output.append('\terror: %s' % logitem['error'])
                 if 'message' in logitem:
                     output.append('\tmessage: %s' % logitem['message'])
                 if 'tag' in logitem:
                     output.append('\ttag: %s' % logitem['tag'])
+                if 'date' in logitem:
+                    output.append('\tdate: %s UTC by %s@%s' % (
+                        logitem['date'], logitem.get('committer'), logitem.get('hostname')))
+                if 'duration' in logitem:
+                    output.append('\tclone: %ss, %s (PostgreSQL %s)' % (
+                        logitem['duration'], format_size(logitem.get('size', 0)),
+                        logitem.get('server_version')))
+                if 'clone_wait' in logitem:
+                    output.append('\tqueued: %ss before the clone' % logitem['clone_wait'])
+                if 'size_before' in logitem:
+                    output.append('\tcompacted: %s -> %s' % (
+                        format_size(logitem['size_before']), format_size(logitem['size_after'])))
         for line in output:
             print(line)
 
@@ -153,6 +296,7 @@ def main():
             print('%(tag)s (%(db)s)' % item)
 
     def tag(args):
+        from .odb import TagExists
         odb = odb_from_conf_file(CONF)
         if args.delete:
             return odb.tag(args.tag, delete=True)
@@ -161,6 +305,76 @@ def main():
         except TagExists:
             print('This tag already exists')
 
+    def verify(args):
+        from .odb import NoTemplate
+        odb = odb_from_conf_file(CONF)
+        kwargs = {'quick': args.quick, 'jobs': args.jobs}
+        if args.revision and args.revision.isdigit():
+            kwargs['revision'] = args.revision
+        elif args.revision:
+            kwargs['tag'] = args.revision
+        try:
+            result = odb.verify(**kwargs)
+        except NoTemplate as e:
+            print(e.args[0])
+            return
+        for revision in sorted(result):
+            if result[revision] is None:
+                print('revision %s: no checksum' % revision)
+            elif result[revision]:
+                print('revision %s: modified %s' % (revision, ', '.join(result[revision])))
+            else:
+                print('revision %s: ok' % revision)
+        if [t for t in result.values() if t]:
+            sys.exit(1)
+
+    def metrics(args):
+        odb = odb_from_conf_file(CONF)
+        if args.output:
+            odb.metrics.export(odb, args.output)
+        else:
+            sys.stdout.write(odb.metrics.render(odb))
+
+    def jobs(args):
+        odb = odb_from_conf_file(CONF)
+        if args.wait:
+            odb.queue.wait(odb.db)
+        if args.clear:
+            for job in odb.queue.clear(odb.db):
+                if job['status'] == 'failed':
+                    print('Forgot the failed revision %s' % job['revision'])
+            return
+        for job in odb.queue.jobs(odb.db):
+            print('revision %(revision)s: %(status)s' % job)
+            if job.get('error'):
+                print('\t%s' % job['error'])
+
+    def transfer(args, push):
+        from .odb import ODB, NoTemplate, TagExists, TransferError
+        odb = odb_from_conf_file(CONF)
+        remote = ODB(args.db or odb.db, user=args.user, password=args.password,
+                     host=args.host, port=args.port)
+        kwargs = {'jobs': args.jobs, 'compress': args.compress}
+        if args.revision and args.revision.isdigit():
+            kwargs['revision'] = args.revision
+        elif args.revision:
+            kwargs['tag'] = args.revision
+        try:
+            if push:
+                revision = odb.push(remote, **kwargs)
+            else:
+                revision = odb.pull(remote, **kwargs)
+        except (NoTemplate, TransferError, TagExists) as e:
+            print(e.args[0])
+            return
+        print('Copied revision %s' % revision)
+
+    def push(args):
+        transfer(args, push=True)
+
+    def pull(args):
+        transfer(args, push=False)
+
     parser_init.set_defaults(func=init)
     parser_commit.set_defaults(func=commit)
     parser_info.set_defaults(func=info)
@@ -170,6 +384,11 @@ def main():
     parser_purge.set_defaults(func=purge)
     parser_tags.set_defaults(func=tags)
     parser_tag.set_defaults(func=tag)
+    parser_verify.set_defaults(func=verify)
+    parser_metrics.set_defaults(func=metrics)
+    parser_jobs.set_defaults(func=jobs)
+    parser_push.set_defaults(func=push)
+    parser_pull.set_defaults(func=pull)
 
     args = parser.parse_args()
     if hasattr(args, 'func'):
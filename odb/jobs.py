@@ -0,0 +1,172 @@
+""" queue of background commits
+
+A background commit assigns the revision immediately and leaves the snapshot
+to a worker process. The jobs of each db are json files processed in order
+by a single worker at a time, which holds a lock on the db::
+
+    <db>.lock
+    <db>/<revision>.json
+
+The current db refuses the connections from the submission of a job until
+the worker cloned it, or failed. The other operations wait for the queue to
+be empty, so they keep their order with the commits. A failed job is kept and
+displayed in the log.
+"""
+import fcntl
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+
+class Queue(object):
+    """ queue of the background commits, stored in the ``path`` directory
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _dir(self, db):
+        path = os.path.join(self.path, db)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def _write(self, job):
+        """ atomically write a job, readable by the owner only
+        because it contains the connection parameters
+        """
+        directory = self._dir(job['db'])
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f, sort_keys=True)
+        os.rename(tmp, os.path.join(directory, '%s.json' % job['revision']))
+
+    def submit(self, odb, revision, parent, metadata, options):
+        """ add a commit job
+        """
+        self._write({
+            'db': odb.db,
+            'revision': revision,
+            'parent': parent,
+            'metadata': metadata,
+            'options': options,
+            'connection': {'user': odb.user, 'password': odb.password,
+                           'host': odb.host, 'port': odb.port},
+            'metrics': odb.metrics.path if odb.metrics is not None else None,
+            'store': [odb.store.path, odb.store.jobs] if odb.store is not None else None,
+            'scheduler': odb.scheduler.settings() if odb.scheduler is not None else None,
+            'status': 'pending',
+            'submitted': time.time(),
+        })
+
+    def jobs(self, db):
+        """ return the jobs of a db, in order
+        """
+        directory = os.path.join(self.path, db)
+        if not os.path.isdir(directory):
+            return []
+        jobs = []
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                with open(os.path.join(directory, name)) as f:
+                    jobs.append(json.load(f))
+        return sorted(jobs, key=lambda j: j['revision'])
+
+    def remove(self, db, revision):
+        path = os.path.join(self.path, db, '%s.json' % revision)
+        if os.path.exists(path):
+            os.unlink(path)
+
+    def clear(self, db):
+        """ remove the finished jobs, and return them
+        """
+        jobs = [j for j in self.jobs(db) if j['status'] in ('done', 'failed')]
+        for job in jobs:
+            self.remove(db, job['revision'])
+        return jobs
+
+    def spawn(self, db):
+        """ start a detached worker for a db
+        """
+        devnull = open(os.devnull, 'r+')
+        subprocess.Popen([sys.executable, '-m', 'odb.jobs', self.path, db],
+                         stdin=devnull, stdout=devnull, stderr=devnull,
+                         close_fds=True, preexec_fn=os.setsid)
+
+    def run(self, db, block=False):
+        """ process the pending jobs of a db, unless another worker does it,
+        in which case return False, or wait for it with ``block``
+        """
+        self._dir(db)
+        lock = open(os.path.join(self.path, '%s.lock' % db), 'a')
+        try:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | (0 if block else fcntl.LOCK_NB))
+            except IOError:
+                return False
+            for job in self.jobs(db):
+                if job['status'] == 'running':  # its worker died
+                    job.update(status='failed', error='The worker was interrupted')
+                    self._unfence(self._odb(job), job)
+                    self._write(job)
+            while True:
+                pending = [j for j in self.jobs(db) if j['status'] == 'pending']
+                if not pending:
+                    return True
+                self._execute(pending[0])
+        finally:
+            lock.close()
+
+    def wait(self, db, delay=0.5):
+        """ wait for the pending and running jobs of a db
+        """
+        while not self.run(db):
+            time.sleep(delay)
+
+    def _odb(self, job):
+        """ the ODB which submitted a job
+        """
+        from .odb import ODB
+        from .metrics import Metrics
+        from .store import Store
+        from .scheduler import Scheduler
+        odb = ODB(job['db'], **job['connection'])
+        if job['metrics']:
+            odb.metrics = Metrics(job['metrics'])
+        if job['store']:
+            odb.store = Store(*job['store'])
+        if job.get('scheduler'):
+            odb.scheduler = Scheduler(**job['scheduler'])
+        return odb
+
+    def _execute(self, job):
+        job.update(status='running', started=time.time())
+        self._write(job)
+        odb = self._odb(job)
+        try:
+            odb.snapshot(job['revision'], job['parent'], job['metadata'], **job['options'])
+        except Exception as e:
+            job.update(status='failed', error=str(e).strip() or repr(e))
+            self._unfence(odb, job)
+        else:
+            job['status'] = 'done'
+            odb._observe('commit', time.time() - job['started'])
+        finally:
+            job['finished'] = time.time()
+            self._write(job)
+
+    def _unfence(self, odb, job):
+        """ lift the fence of the current db after a failed job
+        """
+        try:
+            if job['options'].get('fenced'):
+                odb._fence(False)
+        except Exception:  # the error of the job is more relevant
+            pass
+
+
+if __name__ == '__main__':
+    # worker started by Queue.spawn()
+    Queue(sys.argv[1]).run(sys.argv[2], block=True)
@@ -0,0 +1,140 @@
+""" metrics of the snapshots and operations, in the OpenMetrics text format
+
+The operation latencies are histograms accumulated between runs in a json
+state file, so that ``odb`` can run from cron or CI and the result can be
+exported with the textfile collector of the Prometheus node exporter.
+The concurrent observations are serialized with a lock file next to the
+state file, which is replaced atomically and can't be locked itself.
+"""
+import calendar
+import fcntl
+import json
+import os
+import tempfile
+import time
+
+DURATION_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+RETRY_BUCKETS = (0, 1, 2, 5, 10)
+# histogram name: (metric name, buckets, help)
+HISTOGRAMS = {
+    'commit': ('odb_commit_duration_seconds', DURATION_BUCKETS, 'Duration of the commits'),
+    'revert': ('odb_revert_duration_seconds', DURATION_BUCKETS, 'Duration of the reverts'),
+    'purge': ('odb_purge_duration_seconds', DURATION_BUCKETS, 'Duration of the purges'),
+    'clone_wait': ('odb_clone_wait_seconds', DURATION_BUCKETS,
+                   'Time waited in the queue of the clone scheduler'),
+    'disconnect_retries': ('odb_disconnect_retries', RETRY_BUCKETS,
+                           'Retries needed to disconnect the other clients of a db'),
+}
+
+
+def _write(path, content):
+    """ atomically replace a file, so that readers never see a partial file
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    with os.fdopen(fd, 'w') as f:
+        f.write(content)
+    os.chmod(tmp, 0o644)
+    os.rename(tmp, path)
+
+
+def _label(value):
+    return '"%s"' % str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics(object):
+    """ histograms of the operations of each db, persisted in ``path``
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def observe(self, db, name, value):
+        """ add a value to a histogram of a db
+        """
+        buckets = HISTOGRAMS[name][1]
+        lock = open(self.path + '.lock', 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            state = self.load()
+            histogram = state.setdefault(db, {}).setdefault(
+                name, {'buckets': [0] * (len(buckets) + 1), 'sum': 0, 'count': 0})
+            index = len([b for b in buckets if b < value])
+            histogram['buckets'][index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+            _write(self.path, json.dumps(state, sort_keys=True))
+        finally:
+            lock.close()
+
+    def render(self, odb):
+        """ return the OpenMetrics text of the snapshots of an ODB
+        and of all the histograms
+        """
+        db = _label(odb.db)
+        revs = [r for r in odb.log() if r['db'] != odb.db and 'status' not in r]
+        with odb.connect('postgres') as cn, cn.cursor() as cr:
+            cr.execute("SELECT datname, pg_database_size(datname) FROM pg_catalog.pg_database "
+                       "WHERE datname LIKE %s", (odb.db + '*%',))
+            sizes = dict(cr.fetchall())
+        # a stored revision isn't a database, and only takes the bytes it stored
+        # itself because it shares the chunks of the unchanged tables
+        total = dict(sizes)
+        for rev in revs:
+            if rev.get('storage') == 'store':
+                sizes[rev['db']], total[rev['db']] = rev.get('size', 0), rev.get('stored', 0)
+        lines = [
+            '# TYPE odb_snapshots gauge',
+            '# HELP odb_snapshots Number of snapshots',
+            'odb_snapshots{db=%s} %s' % (db, len(revs)),
+            '# TYPE odb_snapshots_size_bytes gauge',
+            '# UNIT odb_snapshots_size_bytes bytes',
+            '# HELP odb_snapshots_size_bytes Total size of the snapshots',
+            'odb_snapshots_size_bytes{db=%s} %s' % (db, sum(total.get(r['db'], 0) for r in revs)),
+            '# TYPE odb_snapshot_size_bytes gauge',
+            '# UNIT odb_snapshot_size_bytes bytes',
+            '# HELP odb_snapshot_size_bytes Size of each snapshot',
+        ]
+        for rev in revs:
+            lines.append('odb_snapshot_size_bytes{db=%s,revision="%s"} %s'
+                         % (db, rev['revision'], sizes.get(rev['db'], 0)))
+        dates = [r['date'] for r in revs if 'tag' not in r and 'date' in r]
+        if dates:
+            oldest = calendar.timegm(time.strptime(min(dates), '%Y-%m-%d %H:%M:%S'))
+            lines += [
+                '# TYPE odb_oldest_untagged_snapshot_age_seconds gauge',
+                '# UNIT odb_oldest_untagged_snapshot_age_seconds seconds',
+                '# HELP odb_oldest_untagged_snapshot_age_seconds Age of the oldest untagged '
+                'snapshot',
+                'odb_oldest_untagged_snapshot_age_seconds{db=%s} %s' % (db, int(time.time() - oldest)),
+            ]
+        state = self.load()
+        for name in sorted(HISTOGRAMS):
+            metric, buckets, help_ = HISTOGRAMS[name]
+            lines.append('# TYPE %s histogram' % metric)
+            if metric.endswith('_seconds'):
+                lines.append('# UNIT %s seconds' % metric)
+            lines.append('# HELP %s %s' % (metric, help_))
+            for statedb in sorted(state):
+                if name not in state[statedb]:
+                    continue
+                histogram = state[statedb][name]
+                label = _label(statedb)
+                cumulated = 0
+                for bound, count in zip([str(float(b)) for b in buckets] + ['+Inf'],
+                                        histogram['buckets']):
+                    cumulated += count
+                    lines.append('%s_bucket{db=%s,le="%s"} %s' % (metric, label, bound, cumulated))
+                lines.append('%s_sum{db=%s} %s' % (metric, label, histogram['sum']))
+                lines.append('%s_count{db=%s} %s' % (metric, label, histogram['count']))
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def export(self, odb, path):
+        """ atomically write the metrics to a file
+        """
+        _write(path, self.render(odb))
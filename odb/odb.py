@@ -1,6 +1,21 @@
+import getpass
+import json
+import socket
+import time
+from contextlib import contextmanager
+
 import psycopg2
 from psycopg2.extensions import AsIs
 
+# metadata of a snapshot which doesn't belong to the next revision
+SNAPSHOT_KEYS = ('tag', 'message', 'checksums', 'filenodes', 'size_before', 'size_after',
+                 'date', 'duration', 'size', 'server_version', 'committer', 'hostname',
+                 'stored', 'clone_wait')
+# metadata displayed in the log, with their type
+LOG_KEYS = (('tag', str), ('message', str), ('date', str), ('duration', float),
+            ('size', int), ('server_version', str), ('committer', str), ('hostname', str),
+            ('size_before', int), ('size_after', int), ('stored', int), ('clone_wait', float))
+
 
 class TagExists(Exception):
     pass
@@ -10,15 +25,42 @@ class NoTemplate(Exception):
     pass
 
 
+class TransferError(Exception):
+    pass
+
+
+class ReferencedTable(Exception):
+    pass
+
+
+class NotOwner(Exception):
+    pass
+
+
+class UnknownTable(Exception):
+    pass
+
+
 class ODB(object):
     """class representing an Odoo instance
     """
-    def __init__(self, db=None, user=None, password=None, host=None, port=None):
+    def __init__(self, db=None, user=None, password=None, host=None, port=None,
+                 metrics=None, store=None, queue=None, scheduler=None):
         self.db = db
         self.user = user
         self.password = password
         self.host = host
         self.port = port
+        self.metrics = metrics
+        self.store = store
+        self.queue = queue
+        self.scheduler = scheduler
+
+    def _observe(self, name, value):
+        """ record a value in the metrics, if any
+        """
+        if self.metrics is not None:
+            self.metrics.observe(self.db, name, value)
 
     def connect(self, db=None, user=None, password=None, host=None, port=None):
         """ connect to the current db unless specified
@@ -109,15 +151,27 @@ class ODB(object):
         if res is not None and len(res) == 1:
             return res[0]
 
+    def metadata(self, cr=None):
+        """ get all the keys and values in a single query
+        """
+        req = "SELECT substr(key, 5), value FROM ir_config_parameter WHERE key LIKE 'odb.%'"
+        if cr is not None:
+            cr.execute(req)
+            return dict(cr.fetchall())
+        with self.connect() as cn, cn.cursor() as cr:
+            cr.execute(req)
+            return dict(cr.fetchall())
+
     def rem(self, key, cr=None):
-        """ delete a key
+        """ delete a key, or a list of keys
         """
-        req = "DELETE FROM ir_config_parameter WHERE key=%s"
+        req = "DELETE FROM ir_config_parameter WHERE key = ANY(%s)"
+        keys = ['odb.' + k for k in (key if isinstance(key, (list, tuple)) else [key])]
         if cr is not None:
-            cr.execute(req, ('odb.' + key,))
+            cr.execute(req, (keys,))
         else:
             with self.connect() as cn, cn.cursor() as cr:
-                cr.execute(req, ('odb.' + key,))
+                cr.execute(req, (keys,))
 
     def revision(self):
         """ returns the db revision
@@ -129,70 +183,383 @@ class ODB(object):
         """
         return int(self.get('parent'))
 
-    def _disconnect(self, cr, db):
-        """ kill all pg connections
+    def _exists(self, cr, db):
+        """ check that a database exists
+        """
+        cr.execute('SELECT count(*) FROM pg_catalog.pg_database WHERE datname=%s', (db,))
+        return bool(cr.fetchone()[0])
+
+    def _tables(self, cr, kinds=('r',)):
+        """ list the (schema, name) of the user relations of the given kinds
+        """
+        cr.execute("SELECT n.nspname, c.relname FROM pg_catalog.pg_class c "
+                   "JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace "
+                   "WHERE c.relkind IN %s "
+                   "AND n.nspname NOT IN ('pg_catalog', 'information_schema') "
+                   "AND n.nspname NOT LIKE 'pg_toast%%' "
+                   "ORDER BY n.nspname, c.relname", (tuple(kinds),))
+        return cr.fetchall()
+
+    def _resolve(self, revision=None, tag=None):
+        """ return the revision designated by a revision number or a tag,
+        or the current parent if nothing is specified
+        """
+        if revision is None and tag is None:
+            return self.parent()
+        if tag:
+            tagfound = [r for r in self.log() if r.get('tag') == tag]
+            if tagfound:
+                return tagfound[0]['revision']
+            return
+        return int(revision)
+
+    def _disconnect(self, cr, db, retries=10):
+        """ kill all pg connections, and wait for them to be closed
         """
         pid = "pid"
         if cr.connection.server_version < 90200:
             pid = 'procpid'
-        cr.execute("SELECT pg_terminate_backend(pg_stat_activity.%s) "
-                   "FROM pg_stat_activity "
-                   "WHERE pg_stat_activity.datname=%%s "
-                   "AND %s <> pg_backend_pid()" % (pid, pid), (db,))
+        for retry in range(retries + 1):
+            cr.execute("SELECT pg_terminate_backend(pg_stat_activity.%s) "
+                       "FROM pg_stat_activity "
+                       "WHERE pg_stat_activity.datname=%%s "
+                       "AND %s <> pg_backend_pid()" % (pid, pid), (db,))
+            if not cr.rowcount:
+                break
+            time.sleep(0.1 * (retry + 1))
+        self._observe('disconnect_retries', retry)
+
+    def _size(self, cr, db):
+        """ size of a database in bytes
+        """
+        cr.execute('SELECT pg_database_size(%s)', (db,))
+        return cr.fetchone()[0]
+
+    def _settings(self, cr, db):
+        """ encoding, locale and owner of a database, which a clone keeps
+        but an empty database created from template0 doesn't
+        """
+        cr.execute('SELECT pg_encoding_to_char(encoding), datcollate, datctype, '
+                   'pg_get_userbyid(datdba) FROM pg_catalog.pg_database WHERE datname=%s', (db,))
+        return dict(zip(('encoding', 'lc_collate', 'lc_ctype', 'owner'), cr.fetchone()))
+
+    def _create_empty(self, cr, db, settings=None):
+        """ create an empty database with the ``settings`` of another one,
+        except its owner if it doesn't exist or we can't give it the database
+        """
+        query, params = 'CREATE DATABASE "%s" WITH TEMPLATE template0', [AsIs(db)]
+        if settings:
+            query += ' ENCODING %s LC_COLLATE %s LC_CTYPE %s'
+            params += [settings['encoding'], settings['lc_collate'], settings['lc_ctype']]
+            cr.execute("SELECT pg_has_role(oid, 'MEMBER') FROM pg_catalog.pg_roles "
+                       "WHERE rolname=%s", (settings.get('owner'),))
+            if (cr.fetchone() or [False])[0]:
+                query += ' OWNER "%s"'
+                params.append(AsIs(settings['owner']))
+        cr.execute(query, params)
+
+    def _check_transient(self, tables, db=None):
+        """ raise ReferencedTable if other tables reference the tables to truncate,
+        or UnknownTable if one of them doesn't exist
+        """
+        if not tables:
+            return
+        cn = self.connect(db)
+        try:
+            with cn, cn.cursor() as cr:
+                for table in tables:
+                    cr.execute('SELECT to_regclass(%s)', (table,))
+                    if cr.fetchone()[0] is None:
+                        raise UnknownTable('Cannot truncate %s, which does not exist' % table)
+                cr.execute("SELECT DISTINCT confrelid::regclass::text, conrelid::regclass::text "
+                           "FROM pg_catalog.pg_constraint WHERE contype = 'f' "
+                           "AND confrelid = ANY(%s::regclass[]) "
+                           "AND NOT conrelid = ANY(%s::regclass[]) ORDER BY 1, 2",
+                           (tables, tables))
+                references = cr.fetchall()
+        finally:
+            cn.close()
+        if references:
+            raise ReferencedTable('Cannot truncate tables referenced by foreign keys: %s' % (
+                ', '.join('%s (by %s)' % r for r in references)))
+
+    def compact(self, truncate=(), db=None):
+        """ truncate the given transient tables of the current db, or of ``db``,
+        then vacuum and freeze it, so that the next clones are smaller and faster.
+        Return the size before and after. The tables referenced by foreign keys
+        of other tables are rejected, since they are not transient.
+        """
+        db = db or self.db
+        tables = ['"%s"' % '"."'.join(t.split('.')) for t in truncate]
+        self._check_transient(tables, db)
+        cn = self.connect('postgres')
+        cn.autocommit = True
+        with cn.cursor() as cr:
+            self._disconnect(cr, db)
+            size_before = self._size(cr, db)
+        cn = self.connect(db)
+        cn.autocommit = True
+        with cn.cursor() as cr:
+            if tables:
+                cr.execute('TRUNCATE %s', (AsIs(', '.join(tables)),))
+            cr.execute('VACUUM FULL FREEZE ANALYZE')
+            size_after = self._size(cr, db)
+        cn.close()
+        return size_before, size_after
 
-    def commit(self, msg=None):
+    def commit(self, msg=None, checksum=True, compact=False, truncate=(), store=False,
+               background=False):
         """ create a snapshot and change the current revision
+        and record the checksums of the snapshot tables, unless disabled.
+        With ``compact``, the current db is first compacted and the snapshot
+        records the size before and after.
+        The snapshot also records the date (UTC), the duration of the clone,
+        its size, the server version, and the user and host who committed.
+        With ``store``, the revision is saved in the content-addressed store
+        instead of a database, so only the modified tables take space.
+        With ``background``, the revision changes immediately and the snapshot
+        is done by a background worker of the job queue. The current db refuses
+        the connections until the worker cloned it, then the worker compacts
+        or stores the clone instead of the current db.
+        Return the committed revision.
+        """
+        start = time.time()
+        if background and self.queue is None:
+            raise ValueError('The background commits need a queue')
+        self._wait()
+        metadata = self.metadata()
+        revision, parent = int(metadata['revision']), int(metadata['parent'])
+        metadata = {
+            'date': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+            'committer': getpass.getuser(),
+            'hostname': socket.gethostname(),
+            'message': msg or metadata.get('message'),
+            'tag': metadata.get('tag'),
+        }
+        metadata = dict((k, v) for k, v in metadata.items() if v)
+        options = {'checksum': checksum, 'compact': compact, 'truncate': list(truncate),
+                   'store': store}
+        if background:
+            if compact:  # before returning, rather than in the worker
+                self._check_transient(['"%s"' % '"."'.join(t.split('.')) for t in truncate])
+            options['fenced'] = True
+            self._submit(revision, parent, metadata, options)
+            return revision
+        stats = self.snapshot(revision, parent, metadata, **options)
+        self._committed(revision, stats=stats)
+        self._observe('commit', time.time() - start)
+        return revision
+
+    def _submit(self, revision, parent, metadata, options):
+        """ fence the current db, start its next revision and queue the snapshot
+        """
+        # connect before the fence, which keeps the open connections
+        cn = self.connect()
+        try:
+            self._fence()
+        except NotOwner:
+            cn.close()
+            raise
+        try:
+            cn.autocommit = True
+            with cn.cursor() as cr:
+                self._disconnect(cr, self.db)
+                self.queue.submit(self, revision, parent, metadata, options)
+                self._committed(revision, cr)
+        except Exception:
+            self._fence(False)
+            raise
+        finally:
+            cn.close()
+        self.queue.spawn(self.db)
+
+    def _fence(self, fenced=True):
+        """ refuse, or accept again, the connections to the current db.
+        Raise NotOwner if we are neither its owner nor a superuser.
         """
-        if msg:
-            self.set('message', msg)
-        revision = self.revision()
+        cn = self.connect('postgres')
+        cn.autocommit = True
+        try:
+            with cn.cursor() as cr:
+                cr.execute('ALTER DATABASE "%s" ALLOW_CONNECTIONS %s',
+                           (AsIs(self.db), AsIs('false' if fenced else 'true')))
+        except psycopg2.ProgrammingError as e:
+            if e.pgcode != '42501':  # insufficient_privilege
+                raise
+            raise NotOwner('Only the owner of %s can commit in the background' % self.db)
+        finally:
+            cn.close()
+
+    def snapshot(self, revision, parent, metadata, checksum=True, compact=False, truncate=(),
+                 store=False, fenced=False):
+        """ save the current db as ``revision`` with its ``parent`` and metadata,
+        without changing the current revision. See commit() for the options.
+        With ``fenced``, the current db is fenced: the fence is lifted once it is
+        cloned, and the clone is compacted or stored instead.
+        Otherwise, return the table statistics of the current db taken just
+        before the copy, for the next fast revert.
+        """
+        from .reset import take
+        stats = None
+        if compact and not fenced:
+            metadata['size_before'], metadata['size_after'] = self.compact(truncate)
+        if store and not fenced:
+            stats = take(self)
+            self.store.save(self, revision, parent, metadata)
+            return stats
         targetdb = '*'.join([self.db, str(revision)])
         cn = self.connect('postgres')
         cn.autocommit = True
         with cn.cursor() as cr:
-            self._disconnect(cr, self.db)
-            cr.execute('CREATE DATABASE "%s" WITH TEMPLATE "%s"', (AsIs(targetdb), AsIs(self.db)))
-        self.set('revision', revision + 1)
-        self.set('parent', revision)
-        self.rem('tag')
-        self.rem('message')
-
-    def revert(self, parent=None, tag=None):
+            with self._clone_slot(cr) as waited:
+                if not fenced:
+                    stats = take(self)
+                self._disconnect(cr, self.db)
+                clone_start = time.time()
+                cr.execute('CREATE DATABASE "%s" WITH TEMPLATE "%s"',
+                           (AsIs(targetdb), AsIs(self.db)))
+            metadata['duration'] = round(time.time() - clone_start, 3)
+            if self.scheduler is not None:
+                metadata['clone_wait'] = waited
+            metadata['size'] = self._size(cr, targetdb)
+            cr.execute('SHOW server_version')
+            metadata['server_version'] = cr.fetchone()[0]
+        cn.close()
+        try:
+            if fenced:
+                self._fence(False)
+                if compact:
+                    metadata['size_before'], metadata['size_after'] = self.compact(
+                        truncate, targetdb)
+                    metadata['size'] = metadata['size_after']
+                if store:
+                    self.store.save(self, revision, parent, metadata, targetdb)
+                    self.dropdb(targetdb)
+                    return
+            if checksum:
+                from .checksum import checksums, filenodes
+                metadata['checksums'] = json.dumps(
+                    checksums(self, targetdb), sort_keys=True, separators=(',', ':'))
+                metadata['filenodes'] = json.dumps(
+                    filenodes(self, targetdb), sort_keys=True, separators=(',', ':'))
+            with self.connect(targetdb) as cn, cn.cursor() as cr:
+                self.rem(SNAPSHOT_KEYS, cr)
+                self.set('revision', revision, cr)
+                self.set('parent', parent, cr)
+                for key, value in metadata.items():
+                    self.set(key, value, cr)
+            return stats
+        except Exception:  # drop the incomplete snapshot
+            with self.connect('postgres') as cn, cn.cursor() as cr:
+                exists = self._exists(cr, targetdb)
+            if exists:
+                self.dropdb(targetdb)
+            raise
+
+    def _committed(self, revision, cr=None, stats=None):
+        """ start the next revision after a commit, with the table ``stats``
+        taken before the snapshot if the current db wasn't fenced meanwhile
+        """
+        from .reset import record
+        if cr is None:
+            cn = self.connect()
+            try:
+                with cn, cn.cursor() as cr:
+                    return self._committed(revision, cr, stats)
+            finally:
+                cn.close()
+        self.set('revision', revision + 1, cr)
+        self.set('parent', revision, cr)
+        self.rem(SNAPSHOT_KEYS, cr)
+        record(self, revision, cr, stats)
+
+    @contextmanager
+    def _clone_slot(self, cr):
+        """ wait for the scheduler, if any, before a clone on the ``cr``
+        cursor of the postgres db, and yield the time waited
+        """
+        if self.scheduler is None:
+            yield 0
+            return
+        start = time.time()
+        with self.scheduler.slot(cr):
+            waited = round(time.time() - start, 3)
+            self._observe('clone_wait', waited)
+            yield waited
+
+    def _wait(self):
+        """ wait for the background jobs, to keep the operations in order
+        """
+        if self.queue is not None:
+            self.queue.wait(self.db)
+
+    def revert(self, parent=None, tag=None, fast=False):
         """ drop the current db and start back from this parent
-        (or the current parent if no parent is specified)
+        (or the current parent if no parent is specified).
+        With ``fast``, only the tables modified since the last commit or revert
+        are restored from the parent, if possible, and they are returned.
         """
-        if parent is None and tag is None:  # revert to last
-            parent = self.parent()
-        if tag:  # revert to tag
-            tagfound = [r for r in self.log() if r.get('tag') == tag]
-            if tagfound:
-                parent = tagfound[0]['revision']
-            else:
-                return
+        start = time.time()
+        self._wait()
+        parent = self._resolve(parent, tag)
+        if parent is None:  # unknown tag
+            return
         # store revision because we'll drop
         currevision = self.revision()
+        tables = None
+        if fast:
+            from .reset import reset
+            tables = reset(self, parent, currevision)
+        if tables is not None:
+            self._observe('revert', time.time() - start)
+            return tables
         sourcedb = '*'.join([self.db, str(parent)])
-        cn = self.connect()
-        cn.autocommit = True
-        with cn.cursor() as cr:
-            self._disconnect(cr, self.db)
+        # copy aside, to keep the current db if it fails, and to record the
+        # statistics of the copy before any client can connect to it
+        tmpdb = self.db + '~revert'
         cn = self.connect('postgres')
         cn.autocommit = True
         with cn.cursor() as cr:
-            # check that the source db exists to avoid dropping too early
-            cr.execute('SELECT count(*) FROM pg_catalog.pg_database where datname=%s', (sourcedb,))
-            if not cr.fetchone()[0]:
+            if self._exists(cr, sourcedb):
+                with self._clone_slot(cr):
+                    self._disconnect(cr, sourcedb)
+                    cr.execute('CREATE DATABASE "%s" WITH TEMPLATE "%s"',
+                               (AsIs(tmpdb), AsIs(sourcedb)))
+            elif self.store is not None and self.store.exists(self.db, parent):
+                self.store.restore(self, parent, tmpdb)
+            else:
                 raise NoTemplate('Cannot revert because the source db does not exist')
-            cr.execute('DROP DATABASE "%s"', (AsIs(self.db),))
-            self._disconnect(cr, sourcedb)
-            cr.execute('CREATE DATABASE "%s" WITH TEMPLATE "%s"', (AsIs(self.db), AsIs(sourcedb)))
-        self.set('revision', currevision)
-        self.set('parent', parent)
-        self.rem('tag')
-        self.rem('message')
+            try:
+                self._reverted(currevision, parent, tmpdb)
+                self._disconnect(cr, self.db)
+                cr.execute('DROP DATABASE "%s"', (AsIs(self.db),))
+            except Exception:
+                self.dropdb(tmpdb)
+                raise
+            cr.execute('ALTER DATABASE "%s" RENAME TO "%s"', (AsIs(tmpdb), AsIs(self.db)))
+        cn.close()
+        self._observe('revert', time.time() - start)
+
+    def _reverted(self, revision, parent, db):
+        """ restore the current revision in ``db``, the copy of the parent
+        """
+        from .reset import record
+        cn = self.connect(db)
+        try:
+            with cn, cn.cursor() as cr:
+                self.set('revision', revision, cr)
+                self.set('parent', parent, cr)
+                self.rem(SNAPSHOT_KEYS, cr)
+                record(self, parent, cr)
+        finally:
+            cn.close()
 
-    def log(self, limit=None, reversed=True):
-        """ return a list of previous revisions, each revision being a dict with needed infos
+    def log(self, limit=None, reversed=True, since=None, until=None,
+            min_duration=None, min_size=None, committer=None):
+        """ return a list of previous revisions, each revision being a dict with needed infos.
+        The revisions can be filtered on their date (UTC, ``since`` included
+        and ``until`` excluded), their minimum clone duration in seconds,
+        minimum size in bytes or committer.
         """
         log = []
         with self.connect() as cn, cn.cursor() as cr:
@@ -201,17 +568,53 @@ class ODB(object):
             dbnames = cr.fetchall()
         for db in [d[0] for d in dbnames] + [self.db]:
             with self.connect(db) as cn, cn.cursor() as cr:
-                log.append({
-                    'db': db,
-                    'revision': int(self.get('revision', cr)),
-                    'parent': int(self.get('parent', cr)),
-                })
-                tag = self.get('tag', cr)
-                if tag:
-                    log[-1]['tag'] = tag
-                msg = self.get('message', cr)
-                if msg:
-                    log[-1]['message'] = msg
+                metadata = self.metadata(cr)
+            cn.close()
+            log.append({
+                'db': db,
+                'revision': int(metadata['revision']),
+                'parent': int(metadata['parent']),
+            })
+            for key, type_ in LOG_KEYS:
+                if metadata.get(key):
+                    log[-1][key] = type_(metadata[key])
+        # the unfinished jobs replace their incomplete snapshot
+        jobs = [j for j in self.queue.jobs(self.db) if j['status'] != 'done'] \
+            if self.queue is not None else []
+        unfinished = set('%s*%s' % (self.db, j['revision']) for j in jobs)
+        log = [r for r in log if r['db'] not in unfinished]
+        for job in jobs:
+            log.append({
+                'db': '%s*%s' % (self.db, job['revision']),
+                'revision': job['revision'],
+                'parent': job['parent'],
+                'status': job['status'],
+            })
+            if job.get('error'):
+                log[-1]['error'] = job['error']
+            for key, type_ in LOG_KEYS:
+                if job['metadata'].get(key):
+                    log[-1][key] = type_(job['metadata'][key])
+        for manifest in self.store.manifests(self.db) if self.store is not None else []:
+            log.append({
+                'db': '%s*%s' % (self.db, manifest['revision']),
+                'revision': manifest['revision'],
+                'parent': manifest['parent'],
+                'storage': 'store',
+            })
+            for key, type_ in LOG_KEYS:
+                if manifest['metadata'].get(key):
+                    log[-1][key] = type_(manifest['metadata'][key])
+        if since is not None:
+            log = [r for r in log if r.get('date', '') >= since]
+        if until is not None:
+            log = [r for r in log if 'date' in r and r['date'] < until]
+        if min_duration is not None:
+            log = [r for r in log if r.get('duration', -1) >= min_duration]
+        if min_size is not None:
+            log = [r for r in log if r.get('size', -1) >= min_size]
+        if committer is not None:
+            log = [r for r in log if r.get('committer') == committer]
         revs = sorted(log, key=lambda x: x['revision'], reverse=reversed)
         if limit:
             if reversed:
@@ -221,8 +624,9 @@ class ODB(object):
                     revs = revs[len(revs) - limit:]
         return revs
 
-    def glog(self, limit):
-        return self._glog_output(self.log(limit, reversed=False))
+    def glog(self, limit, **filters):
+        revs = self.log(limit, reversed=False, **filters)
+        return self._glog_output(revs) if revs else []
 
     def _nb_interval(self, children_count):
         interval = (children_count - 1) * 2
@@ -277,6 +681,42 @@ class ODB(object):
         output.reverse()
         return output
 
+    def verify(self, revision=None, tag=None, quick=False, jobs=4):
+        """ check the snapshots against the checksums recorded at commit time
+        and return a {revision: tampered tables} dict for the given revision
+        or all of them, the tampered tables being None if there is no checksum.
+        With ``quick``, only the tables with write statistics are rechecked.
+        """
+        from .checksum import verify
+        self._wait()
+        if revision is not None or tag is not None:
+            revision = self._resolve(revision, tag)
+            if revision is None:
+                raise NoTemplate('This tag does not exist')
+        result = {}
+        for logitem in self.log():
+            if logitem['db'] == self.db:
+                continue
+            if revision is not None and logitem['revision'] != revision:
+                continue
+            if logitem.get('status') == 'failed':
+                continue
+            if logitem.get('storage') == 'store':
+                result[logitem['revision']] = self.store.verify(self.db, logitem['revision'])
+                continue
+            with self.connect(logitem['db']) as cn, cn.cursor() as cr:
+                recorded = self.get('checksums', cr)
+                recorded_filenodes = self.get('filenodes', cr)
+            if recorded is None:
+                result[logitem['revision']] = None
+                continue
+            result[logitem['revision']] = verify(
+                self, logitem['db'], json.loads(recorded), quick=quick, jobs=jobs,
+                recorded_filenodes=json.loads(recorded_filenodes or 'null'))
+        if revision is not None and revision not in result:
+            raise NoTemplate('This revision does not exist')
+        return result
+
     def purge(self, what, confirm=False):
         """ purge the revisions
         ``what`` can be::
@@ -292,18 +732,30 @@ class ODB(object):
         else:
             raise NotImplementedError('Bad purge command')
         if confirm:
+            start = time.time()
+            self._wait()
             for logitem in to_purge:
-                self.dropdb(logitem['db'])
+                if logitem.get('storage') == 'store':
+                    self.store.remove(self.db, logitem['revision'])
+                elif logitem.get('status') != 'failed':
+                    self.dropdb(logitem['db'])
+                if self.queue is not None:
+                    self.queue.remove(self.db, logitem['revision'])
+            self._observe('purge', time.time() - start)
         return to_purge
 
     def tag(self, tag=None, revision=None, delete=False):
         """ tag a specific revision or the current one by default
         """
+        if tag is not None:  # the revision may still be committed in the background
+            self._wait()
         tags = [r for r in self.log() if 'tag' in r]
         if delete:
             if tag in [r.get('tag') for r in tags]:
-                db = [r['db'] for r in tags if r.get('tag') == tag][0]
-                with self.connect(db) as cn, cn.cursor() as cr:
+                logitem = [r for r in tags if r.get('tag') == tag][0]
+                if logitem.get('storage') == 'store':
+                    return self._tag_stored(logitem['revision'], None)
+                with self.connect(logitem['db']) as cn, cn.cursor() as cr:
                     return self.rem('tag', cr)
             return
         if tag is None and revision is None:
@@ -314,7 +766,45 @@ class ODB(object):
             revision = self.revision()
         if self.revision() == revision:
             db = self.db
+        elif self.store is not None and self.store.exists(self.db, revision):
+            return self._tag_stored(revision, tag)
         else:
             db = '%s*%s' % (self.db, revision)
         with self.connect(db) as cn, cn.cursor() as cr:
             self.set('tag', tag, cr)
+
+    def _tag_stored(self, revision, tag):
+        """ set or remove the tag of a revision of the store
+        """
+        manifest = self.store.manifest(self.db, revision)
+        manifest['metadata'].pop('tag', None)
+        if tag is not None:
+            manifest['metadata']['tag'] = tag
+        self.store.write(self.db, manifest)
+
+    def push(self, remote, revision=None, tag=None, jobs=4, compress=6):
+        """ copy a revision (the parent by default) with its metadata
+        to the same revision of ``remote``, an ODB on another cluster.
+        The current revision of ``remote`` is moved after the copied one.
+        """
+        from .transfer import transfer
+        self._wait()
+        revision = self._resolve(revision, tag)
+        if revision is None:
+            raise NoTemplate('This tag does not exist')
+        transfer(self, remote, revision, jobs=jobs, compress=compress)
+        return revision
+
+    def pull(self, remote, revision=None, tag=None, jobs=4, compress=6):
+        """ copy a revision (the parent by default) with its metadata
+        from ``remote``, an ODB on another cluster.
+        The current revision is moved after the copied one.
+        """
+        from .transfer import transfer
+        self._wait()
+        remote._wait()
+        revision = remote._resolve(revision, tag)
+        if revision is None:
+            raise NoTemplate('This tag does not exist')
+        transfer(remote, self, revision, jobs=jobs, compress=compress)
+        return revision
@@ -0,0 +1,171 @@
+""" fast reset of the current db, restoring only the modified tables
+
+After each commit or revert, the write statistics and the file of the tables
+are recorded in the current db. The next fast revert to the same parent compares them with
+the current statistics to find the modified tables, and copies only these
+tables from the parent snapshot, in a single transaction. The db doesn't
+accept connections meanwhile, so that no write is missed or recorded in the
+next statistics. It gives up, so that a full clone is done, when the schema
+changed, the statistics were reset, the db can't be fenced because we don't
+own it, or the server is older than PostgreSQL 15, which flushes the
+statistics of the disconnected clients only since then.
+"""
+import json
+import tempfile
+
+import psycopg2
+from psycopg2.extensions import AsIs
+
+USER = ("n.nspname NOT IN ('pg_catalog', 'information_schema') "
+        "AND n.nspname NOT LIKE 'pg_toast%'")
+SCHEMA = """
+SELECT md5(string_agg(item, ',' ORDER BY item)) FROM (
+    SELECT format('%s.%s:%s', n.nspname, c.relname, c.relkind) AS item
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace WHERE {user}
+  UNION ALL
+    SELECT format('%s.%s.%s:%s:%s:%s:%s', n.nspname, c.relname, a.attnum, a.attname,
+                  format_type(a.atttypid, a.atttypmod), a.attnotnull,
+                  pg_get_expr(d.adbin, d.adrelid))
+    FROM pg_attribute a JOIN pg_class c ON c.oid = a.attrelid
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_attrdef d ON d.adrelid = a.attrelid AND d.adnum = a.attnum
+    WHERE a.attnum > 0 AND NOT a.attisdropped AND {user}
+  UNION ALL
+    SELECT format('%s.%s:%s', n.nspname, o.conname, pg_get_constraintdef(o.oid))
+    FROM pg_constraint o JOIN pg_namespace n ON n.oid = o.connamespace WHERE {user}
+  UNION ALL
+    SELECT pg_get_triggerdef(t.oid) FROM pg_trigger t WHERE NOT t.tgisinternal
+  UNION ALL
+    SELECT format('%s.%s(%s):%s', n.nspname, p.proname,
+                  pg_get_function_identity_arguments(p.oid), md5(p.prosrc))
+    FROM pg_proc p JOIN pg_namespace n ON n.oid = p.pronamespace WHERE {user}
+  UNION ALL
+    SELECT format('%s.%s:%s', schemaname, viewname, md5(definition))
+    FROM pg_views WHERE schemaname NOT IN ('pg_catalog', 'information_schema')
+) items
+""".format(user=USER)
+# the file of a table changes with TRUNCATE, which the counters ignore
+STATS = ("SELECT s.schemaname || '.' || s.relname, array[s.n_tup_ins, s.n_tup_upd, "
+         "s.n_tup_del, s.n_live_tup, c.relfilenode::bigint] FROM pg_stat_user_tables s "
+         "JOIN pg_class c ON c.oid = s.relid")
+STATS_RESET = "SELECT stats_reset::text FROM pg_stat_database WHERE datname = current_database()"
+
+
+def _fingerprint(cr):
+    cr.execute(SCHEMA)
+    return cr.fetchone()[0]
+
+
+def _stats(cr):
+    cr.execute('SELECT pg_stat_clear_snapshot()')
+    cr.execute(STATS)
+    stats = dict(cr.fetchall())
+    cr.execute(STATS_RESET)
+    return stats, cr.fetchone()[0]
+
+
+def take(odb):
+    """ disconnect the clients of the current db and return its statistics,
+    to record() them once it is copied: the writes done meanwhile are then
+    restored by the next reset, instead of being part of the baseline
+    """
+    cn = odb.connect()
+    cn.autocommit = True
+    try:
+        with cn.cursor() as cr:
+            odb._disconnect(cr, odb.db)
+            return _stats(cr)
+    finally:
+        cn.close()
+
+
+def record(odb, parent, cr=None, stats=None):
+    """ record the statistics of the current db, which is a copy of ``parent``,
+    or the ``stats`` taken before it was copied
+    """
+    if cr is None:
+        with odb.connect() as cn, cn.cursor() as cr:
+            return record(odb, parent, cr, stats)
+    stats, stats_reset = stats or _stats(cr)
+    baseline = {'parent': int(parent), 'stats_reset': stats_reset, 'tables': stats}
+    odb.set('tablestats', json.dumps(baseline, sort_keys=True, separators=(',', ':')), cr)
+
+
+def reset(odb, parent, revision):
+    """ restore the tables modified since the last commit or revert from the
+    ``parent`` snapshot, set the current ``revision`` and return the tables,
+    or return None if a full clone is needed
+    """
+    sourcedb = '*'.join([odb.db, str(parent)])
+    cn = odb.connect('postgres')
+    cn.autocommit = True
+    try:
+        with cn.cursor() as cr:
+            if cn.server_version < 150000 or not odb._exists(cr, sourcedb):
+                return
+        target, source = odb.connect(), odb.connect(sourcedb)
+        try:
+            with cn.cursor() as cr:
+                try:
+                    cr.execute('ALTER DATABASE "%s" ALLOW_CONNECTIONS false', (AsIs(odb.db),))
+                except psycopg2.Error:  # not the owner
+                    return
+            try:
+                return _reset(odb, parent, revision, target, source)
+            finally:
+                with cn.cursor() as cr:
+                    cr.execute('ALTER DATABASE "%s" ALLOW_CONNECTIONS true', (AsIs(odb.db),))
+        finally:
+            target.close()
+            source.close()
+    finally:
+        cn.close()
+
+
+def _reset(odb, parent, revision, target, source):
+    """ reset with the ``target`` connection to the fenced current db
+    """
+    from .odb import SNAPSHOT_KEYS
+    target.autocommit = True
+    with target.cursor() as cr:
+        odb._disconnect(cr, odb.db)
+    target.autocommit = False
+    with target.cursor() as cr, source.cursor() as source_cr:
+        baseline = odb.get('tablestats', cr)
+        if baseline is None:
+            return
+        baseline = json.loads(baseline)
+        stats, stats_reset = _stats(cr)
+        if (baseline['parent'] != int(parent) or baseline['stats_reset'] != stats_reset
+                or set(stats) != set(baseline['tables'])
+                or _fingerprint(cr) != _fingerprint(source_cr)):
+            return
+        dirty = sorted(set(t for t in stats if stats[t] != baseline['tables'][t])
+                       | set(['public.ir_config_parameter']))
+        # disable the triggers, including the foreign keys
+        try:
+            cr.execute('SET LOCAL session_replication_role = replica')
+        except psycopg2.Error:  # not a superuser
+            return
+        for table in dirty:
+            table = '"%s"."%s"' % tuple(table.split('.', 1))
+            with tempfile.TemporaryFile() as data:
+                source_cr.copy_expert('COPY %s TO STDOUT' % table, data)
+                data.seek(0)
+                cr.execute('DELETE FROM %s', (AsIs(table),))
+                cr.copy_expert('COPY %s FROM STDIN' % table, data)
+        for schema, name in odb._tables(source_cr, ('S',)):
+            source_cr.execute('SELECT last_value, is_called FROM "%s"."%s"',
+                              (AsIs(schema), AsIs(name)))
+            cr.execute('SELECT setval(%s, %s, %s)',
+                       ('"%s"."%s"' % (schema, name),) + source_cr.fetchone())
+        odb.set('revision', revision, cr)
+        odb.set('parent', parent, cr)
+        odb.rem(SNAPSHOT_KEYS, cr)
+        # flush our statistics when committing, for the record
+        cr.execute('SELECT pg_stat_force_next_flush()')
+        target.commit()
+        # record before lifting the fence, so that no other write is included
+        record(odb, parent, cr)
+        target.commit()
+    return dirty
@@ -0,0 +1,107 @@
+""" cluster-wide scheduler of the clones
+
+``CREATE DATABASE ... WITH TEMPLATE`` copies the whole template and can
+saturate the disks of a cluster shared by several developers and CI jobs.
+The scheduler limits the number of concurrent clones of all the ODB of a
+cluster with advisory locks of the ``postgres`` db, which are released by the
+server if a client dies:
+
+- the clients queue in arrival order on a turnstile lock,
+- the first one waits for one of the ``max_clones`` slot locks, then leaves
+  the turnstile to the next one and clones while it holds its slot.
+
+Optionally, the first client also waits while the cluster is under pressure:
+requested checkpoints, meaning that the WAL grows faster than
+``max_wal_size``, or replicas lagging behind. This backoff is limited to
+``max_backoff`` seconds, so that the clones are slowed down, never blocked.
+"""
+import time
+from contextlib import contextmanager
+
+NAMESPACE = 0x6f6462  # 'odb', first key of the advisory locks
+TURNSTILE = 0
+
+
+class Scheduler(object):
+    """ limit the concurrent clones of a cluster to ``max_clones``.
+    With ``checkpoint_backoff``, wait while checkpoints are requested, and with
+    ``max_replication_lag`` (in seconds), wait while a replica lags more.
+    """
+    def __init__(self, max_clones=2, checkpoint_backoff=False, max_replication_lag=None,
+                 max_backoff=300, delay=1):
+        self.max_clones = max(max_clones, 1)
+        self.checkpoint_backoff = checkpoint_backoff
+        self.max_replication_lag = max_replication_lag
+        self.max_backoff = max_backoff
+        self.delay = delay
+
+    def settings(self):
+        """ the arguments of the scheduler, to recreate it in another process
+        """
+        return {'max_clones': self.max_clones, 'checkpoint_backoff': self.checkpoint_backoff,
+                'max_replication_lag': self.max_replication_lag,
+                'max_backoff': self.max_backoff, 'delay': self.delay}
+
+    def _checkpoints(self, cr):
+        """ number of requested checkpoints since the statistics reset
+        """
+        if cr.connection.server_version >= 170000:
+            cr.execute('SELECT num_requested FROM pg_stat_checkpointer')
+        else:
+            cr.execute('SELECT checkpoints_req FROM pg_stat_bgwriter')
+        return cr.fetchone()[0]
+
+    def _replication_lag(self, cr):
+        """ highest replay lag of the replicas, in seconds. It is only visible
+        to the superusers and the members of pg_read_all_stats.
+        """
+        cr.execute('SELECT coalesce(extract(epoch FROM max(replay_lag)), 0) '
+                   'FROM pg_stat_replication')
+        return float(cr.fetchone()[0])
+
+    def pressure(self, cr):
+        """ return the reason why the cluster is under pressure, or None.
+        The requested checkpoints are counted during ``delay``, the cursor
+        must be in autocommit to see new statistics.
+        """
+        if self.max_replication_lag is not None:
+            lag = self._replication_lag(cr)
+            if lag > self.max_replication_lag:
+                return 'replication lag of %.1fs' % lag
+        if self.checkpoint_backoff:
+            checkpoints = self._checkpoints(cr)
+            time.sleep(self.delay)
+            if self._checkpoints(cr) > checkpoints:
+                return 'requested checkpoints'
+
+    def _acquire(self, cr):
+        """ try to take a free slot, and return it or None
+        """
+        for slot in range(1, self.max_clones + 1):
+            cr.execute('SELECT pg_try_advisory_lock(%s, %s)', (NAMESPACE, slot))
+            if cr.fetchone()[0]:
+                return slot
+
+    @contextmanager
+    def slot(self, cr):
+        """ wait for the turn of a clone on the ``cr`` cursor of the
+        ``postgres`` db in autocommit, and hold its slot in the block
+        """
+        cr.execute('SELECT pg_advisory_lock(%s, %s)', (NAMESPACE, TURNSTILE))
+        try:
+            slot = self._acquire(cr)
+            while slot is None:
+                time.sleep(self.delay)
+                slot = self._acquire(cr)
+            deadline = time.time() + self.max_backoff
+            while time.time() < deadline and self.pressure(cr):
+                time.sleep(self.delay)
+        except BaseException:
+            cr.execute('SELECT pg_advisory_unlock_all()')
+            raise
+        cr.execute('SELECT pg_advisory_unlock(%s, %s)', (NAMESPACE, TURNSTILE))
+        try:
+            yield slot
+        finally:
+            if not cr.connection.closed:  # else the server released the lock
+                cr.execute('SELECT pg_advisory_unlock(%s, %s)', (NAMESPACE, slot))
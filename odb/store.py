@@ -0,0 +1,341 @@
+""" content-addressed store of revisions, deduplicated per table
+
+Instead of a full copy of the database, a revision is stored as a manifest
+referencing compressed chunks named by the sha256 of their content:
+the schema before and after the data, and the COPY of each table.
+Tables which didn't change since the previous revision produce the same
+chunk, so they are stored only once::
+
+    objects/ab/abcdef...                 zlib compressed chunks
+    revisions/<db>/<revision>.json       manifests
+    lock
+
+The saves and restores share the lock, which the garbage collection takes
+exclusively, so that it never removes the chunks of a save in progress.
+"""
+import fcntl
+import hashlib
+import json
+import os
+import subprocess
+import tempfile
+import time
+import zlib
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+from psycopg2.extensions import AsIs
+
+from .odb import TransferError
+from .transfer import _env, _connection_string
+
+BUFSIZE = 1024 * 1024
+
+
+class _Writer(object):
+    """ file-like object hashing and compressing what is written to a temp file
+    """
+    def __init__(self, directory):
+        fd, self.path = tempfile.mkstemp(dir=directory)
+        self.file = os.fdopen(fd, 'wb')
+        self.hash = hashlib.sha256()
+        self.compressor = zlib.compressobj()
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.hash.update(data)
+        self.file.write(self.compressor.compress(data))
+
+    def close(self):
+        self.file.write(self.compressor.flush())
+        self.file.close()
+        return self.hash.hexdigest()
+
+
+class _Reader(object):
+    """ file-like object decompressing a chunk
+    """
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b''
+
+    def read(self, size=BUFSIZE):
+        while len(self.buffer) < size:
+            data = self.file.read(BUFSIZE)
+            if not data:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(data)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+class Store(object):
+    """ content-addressed store of revisions in the ``path`` directory
+    """
+    def __init__(self, path, jobs=4):
+        self.path = path
+        self.jobs = max(jobs, 1)
+
+    def _object(self, digest):
+        return os.path.join(self.path, 'objects', digest[:2], digest)
+
+    def _manifest(self, db, revision):
+        return os.path.join(self.path, 'revisions', db, '%s.json' % revision)
+
+    def _put(self, writer):
+        """ move a written chunk to its final place and return its digest
+        and the number of new bytes, which is 0 if it was already stored
+        """
+        digest = writer.close()
+        path = self._object(digest)
+        if os.path.exists(path):
+            os.unlink(writer.path)
+            return digest, 0
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        os.rename(writer.path, path)
+        return digest, os.path.getsize(path)
+
+    @contextmanager
+    def _lock(self, shared=False):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        lock = open(os.path.join(self.path, 'lock'), 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+        finally:
+            lock.close()
+
+    def _tmpdir(self):
+        path = os.path.join(self.path, 'tmp')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return path
+
+    def _dump(self, odb, db, snapshot, section):
+        """ store a section of the schema
+        """
+        writer = _Writer(self._tmpdir())
+        stderr = tempfile.TemporaryFile()
+        dump = subprocess.Popen(
+            ['pg_dump', '--format=plain', '--no-owner', '--no-privileges',
+             '--section=%s' % section, '--snapshot=%s' % snapshot,
+             '--dbname=%s' % _connection_string(odb, db)],
+            stdout=subprocess.PIPE, stderr=stderr, env=_env(odb))
+        for data in iter(lambda: dump.stdout.read(BUFSIZE), b''):
+            writer.write(data)
+        if dump.wait():
+            writer.close()
+            os.unlink(writer.path)
+            stderr.seek(0)
+            raise TransferError(stderr.read().decode('utf-8', 'replace').strip())
+        return self._put(writer)
+
+    def _psql(self, odb, db, digest):
+        """ run a stored section of the schema
+        """
+        reader = _Reader(self._object(digest))
+        stderr = tempfile.TemporaryFile()
+        psql = subprocess.Popen(
+            ['psql', '--no-psqlrc', '--quiet', '--set=ON_ERROR_STOP=1',
+             '--dbname=%s' % _connection_string(odb, db)],
+            stdin=subprocess.PIPE, stdout=stderr, stderr=stderr, env=_env(odb))
+        try:
+            for data in iter(reader.read, b''):
+                psql.stdin.write(data)
+        except IOError:  # psql stopped on error
+            pass
+        finally:
+            reader.close()
+        psql.stdin.close()
+        if psql.wait():
+            stderr.seek(0)
+            raise TransferError(stderr.read().decode('utf-8', 'replace').strip())
+
+    def save(self, odb, revision, parent, metadata, db=None):
+        """ store the current db of an ODB, or its ``db`` copy, as ``revision``.
+        The duration, size and newly stored bytes are added to the metadata.
+        """
+        with self._lock(shared=True):
+            return self._save(odb, revision, parent, metadata, db or odb.db)
+
+    def _save(self, odb, revision, parent, metadata, db):
+        start = time.time()
+        cn = odb.connect(db)
+        cn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+        try:
+            with cn.cursor() as cr:
+                cr.execute('SELECT pg_export_snapshot()')
+                snapshot = cr.fetchone()[0]
+                tables = odb._tables(cr, ('r',))
+                sequences = {}
+                for schema, name in odb._tables(cr, ('S',)):
+                    cr.execute('SELECT last_value, is_called FROM "%s"."%s"', (AsIs(schema), AsIs(name)))
+                    sequences['%s.%s' % (schema, name)] = list(cr.fetchone())
+                cr.execute('SHOW server_version')
+                server_version = cr.fetchone()[0]
+                settings = odb._settings(cr, odb.db)
+
+            def copy(table):
+                writer = _Writer(self._tmpdir())
+                worker = odb.connect(db)
+                try:
+                    worker.set_session(isolation_level='REPEATABLE READ', readonly=True)
+                    with worker.cursor() as cr:
+                        cr.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+                        cr.copy_expert('COPY "%s"."%s" TO STDOUT' % table, writer)
+                finally:
+                    worker.close()
+                return table, self._put(writer)
+
+            pre_data = self._dump(odb, db, snapshot, 'pre-data')
+            pool = ThreadPool(self.jobs)
+            try:
+                copied = pool.map(copy, tables)
+            finally:
+                pool.close()
+                pool.join()
+            post_data = self._dump(odb, db, snapshot, 'post-data')
+        finally:
+            cn.close()
+        chunks = [pre_data, post_data] + [c[1] for c in copied]
+        sizes = dict((digest, os.path.getsize(self._object(digest))) for digest, _ in chunks)
+        metadata.update({
+            'server_version': server_version,
+            'duration': round(time.time() - start, 3),
+            'size': sum(sizes.values()),
+            'stored': sum(c[1] for c in chunks),
+        })
+        manifest = {
+            'revision': revision,
+            'parent': int(parent),
+            'metadata': metadata,
+            'pre_data': pre_data[0],
+            'post_data': post_data[0],
+            'tables': dict(('%s.%s' % table, chunk[0]) for table, chunk in copied),
+            'sequences': sequences,
+            'settings': settings,
+        }
+        self.write(odb.db, manifest)
+        return manifest
+
+    def restore(self, odb, revision, db):
+        """ create ``db`` from a stored revision of an ODB, with the encoding,
+        locale and owner of the saved db, loading the tables in parallel
+        """
+        with self._lock(shared=True):
+            self._restore(odb, revision, db)
+
+    def _restore(self, odb, revision, db):
+        manifest = self.manifest(odb.db, revision)
+        cn = odb.connect('postgres')
+        cn.autocommit = True
+        with cn.cursor() as cr:
+            odb._create_empty(cr, db, manifest.get('settings'))
+
+        def copy(item):
+            table, digest = item
+            reader = _Reader(self._object(digest))
+            worker = odb.connect(db)
+            try:
+                with worker, worker.cursor() as cr:
+                    cr.copy_expert('COPY "%s"."%s" FROM STDIN' % tuple(table.split('.', 1)),
+                                   reader)
+            finally:
+                reader.close()
+                worker.close()
+
+        try:
+            self._psql(odb, db, manifest['pre_data'])
+            pool = ThreadPool(self.jobs)
+            try:
+                pool.map(copy, sorted(manifest['tables'].items()))
+            finally:
+                pool.close()
+                pool.join()
+            with odb.connect(db) as cn, cn.cursor() as cr:
+                for sequence, (value, called) in manifest['sequences'].items():
+                    sequence = '"%s"."%s"' % tuple(sequence.split('.', 1))
+                    cr.execute('SELECT setval(%s, %s, %s)', (sequence, value, called))
+            self._psql(odb, db, manifest['post_data'])
+        except Exception:
+            odb.dropdb(db)
+            raise
+
+    def write(self, db, manifest):
+        path = self._manifest(db, manifest['revision'])
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, sort_keys=True)
+        os.rename(tmp, path)
+
+    def manifest(self, db, revision):
+        with open(self._manifest(db, revision)) as f:
+            return json.load(f)
+
+    def manifests(self, db):
+        """ return the manifests of all the stored revisions of a db
+        """
+        path = os.path.join(self.path, 'revisions', db)
+        if not os.path.isdir(path):
+            return []
+        return [self.manifest(db, name[:-5]) for name in sorted(os.listdir(path))
+                if name.endswith('.json')]
+
+    def exists(self, db, revision):
+        return os.path.exists(self._manifest(db, revision))
+
+    def remove(self, db, revision):
+        """ remove a stored revision then the chunks not used anymore
+        """
+        os.unlink(self._manifest(db, revision))
+        self.gc()
+
+    def gc(self):
+        """ remove the chunks which are not referenced by any manifest
+        """
+        with self._lock():
+            self._gc()
+
+    def _gc(self):
+        used = set()
+        revisions = os.path.join(self.path, 'revisions')
+        for db in os.listdir(revisions) if os.path.isdir(revisions) else []:
+            for manifest in self.manifests(db):
+                used.update([manifest['pre_data'], manifest['post_data']])
+                used.update(manifest['tables'].values())
+        objects = os.path.join(self.path, 'objects')
+        for prefix in os.listdir(objects) if os.path.isdir(objects) else []:
+            for digest in os.listdir(os.path.join(objects, prefix)):
+                if digest not in used:
+                    os.unlink(os.path.join(objects, prefix, digest))
+
+    def verify(self, db, revision):
+        """ return the sorted list of tables whose chunk is missing or corrupted
+        """
+        manifest = self.manifest(db, revision)
+        chunks = dict(manifest['tables'])
+        chunks.update({'pre-data': manifest['pre_data'], 'post-data': manifest['post_data']})
+        tampered = []
+        for name, digest in chunks.items():
+            try:
+                reader = _Reader(self._object(digest))
+                hash_ = hashlib.sha256()
+                for data in iter(reader.read, b''):
+                    hash_.update(data)
+                reader.close()
+            except (IOError, OSError, zlib.error):
+                tampered.append(name)
+                continue
+            if hash_.hexdigest() != digest:
+                tampered.append(name)
+        return sorted(tampered)
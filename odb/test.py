@@ -1,7 +1,35 @@
+import os
+import shutil
+import tempfile
 import unittest
 import time
+import threading
 
-from .odb import ODB, TagExists, NoTemplate
+import psycopg2
+
+from .odb import (ODB, TagExists, NoTemplate, TransferError, ReferencedTable, NotOwner,
+                  UnknownTable)
+from .metrics import Metrics
+from .store import Store
+from .jobs import Queue
+from .scheduler import Scheduler
+
+
+def _recreate_with_another_encoding(odb):
+    """ recreate the db of an ODB with another encoding than the default one
+    and return its settings
+    """
+    cn = odb.connect('postgres')
+    cn.autocommit = True
+    with cn.cursor() as cr:
+        settings = odb._settings(cr, odb.db)
+        settings['encoding'] = 'LATIN1' if settings['encoding'] == 'UTF8' else 'UTF8'
+        cr.execute('DROP DATABASE "%s"' % odb.db)
+        odb._create_empty(cr, odb.db, settings)
+    cn.close()
+    with odb.connect() as cn, cn.cursor() as cr:
+        cr.execute("CREATE TABLE ir_config_parameter (key varchar(256), value text)")
+    return settings
 
 
 class TestCommit(unittest.TestCase):
@@ -330,6 +358,368 @@ class TestCommit(unittest.TestCase):
             'o\t1: commit 1', ]
         self.assertEqual(expected, output)
 
+    def test_verify(self):
+        odb = ODB(self.db)
+        odb.init()
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("CREATE TABLE partner (id serial PRIMARY KEY, name text)")
+            cr.execute("INSERT INTO partner (name) VALUES ('foo'), ('bar')")
+        odb.commit()
+        odb.commit(checksum=False)
+        self.assertEqual(odb.verify(), {1: [], 2: None})
+        # the working db doesn't inherit the checksums
+        odb.revert(1)
+        self.assertEqual(odb.get('checksums'), None)
+        # tamper the snapshot
+        with odb.connect(self.db + '*1') as cn, cn.cursor() as cr:
+            cr.execute("UPDATE partner SET name='baz' WHERE name='bar'")
+            cr.execute("SELECT nextval('partner_id_seq')")
+            cr.execute("CREATE TABLE other (id integer)")
+        cn.close()
+        time.sleep(1)  # let the statistics be flushed
+        expected = ['public.other', 'public.partner', 'public.partner_id_seq']
+        self.assertEqual(odb.verify(1), {1: expected})
+        self.assertEqual(odb.verify(1, quick=True), {1: expected})
+        self.assertRaises(NoTemplate, odb.verify, 3)
+        # neither a TRUNCATE nor a reset of the statistics hides a change
+        odb.commit()
+        with odb.connect(self.db + '*3') as cn, cn.cursor() as cr:
+            cr.execute("TRUNCATE partner")
+        cn.close()
+        self.assertEqual(odb.verify(3, quick=True), {3: ['public.partner']})
+        odb.commit()
+        with odb.connect(self.db + '*4') as cn, cn.cursor() as cr:
+            cr.execute("UPDATE partner SET name = 'qux'")
+        cn.close()
+        time.sleep(1)
+        with odb.connect(self.db + '*4') as cn, cn.cursor() as cr:
+            cr.execute("SELECT pg_stat_reset()")
+        cn.close()
+        self.assertEqual(odb.verify(4, quick=True), {4: ['public.partner']})
+
+    def test_compact(self):
+        odb = ODB(self.db)
+        odb.init()
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("CREATE TABLE bus_bus (id serial PRIMARY KEY, message text)")
+            cr.execute("INSERT INTO bus_bus (message) "
+                       "SELECT repeat('x', 100) FROM generate_series(1, 10000)")
+            cr.execute("DELETE FROM bus_bus WHERE id > 10")
+            cr.execute("CREATE TABLE mail_message (id serial PRIMARY KEY)")
+            cr.execute("CREATE TABLE mail_tracking_value (message_id integer "
+                       "REFERENCES mail_message)")
+        # the referenced tables are not transient
+        self.assertRaises(ReferencedTable, odb.commit, compact=True,
+                          truncate=['public.bus_bus', 'mail_message'])
+        # as well as the missing ones
+        for missing in 'bus_bsu', 'nowhere.bus_bus':
+            self.assertRaises(UnknownTable, odb.commit, compact=True, truncate=[missing])
+        self.assertEqual(odb.revision(), 1)
+        odb.commit(compact=True, truncate=['public.bus_bus'])
+        with odb.connect(self.db + '*1') as cn, cn.cursor() as cr:
+            self.assertGreater(int(odb.get('size_before', cr)), int(odb.get('size_after', cr)))
+            cr.execute("SELECT count(*) FROM bus_bus")
+            self.assertEqual(cr.fetchone()[0], 0)
+        self.assertEqual(odb.verify(), {1: []})
+        self.assertEqual(odb.get('size_before'), None)
+
+    def test_log_metadata(self):
+        odb = ODB(self.db)
+        odb.init()
+        odb.commit()
+        odb.commit()
+        revs = odb.log()
+        self.assertEqual([r['revision'] for r in revs], [3, 2, 1])
+        self.assertNotIn('date', revs[0])
+        for rev in revs[1:]:
+            self.assertEqual(rev['date'][:4], time.strftime('%Y', time.gmtime()))
+            self.assertGreaterEqual(rev['duration'], 0)
+            self.assertGreater(rev['size'], 0)
+            self.assertIn('committer', rev)
+            self.assertIn('hostname', rev)
+            self.assertIn('server_version', rev)
+        self.assertEqual(odb.get('date'), None)
+        # all the keys in one query
+        odb.tag('v1')
+        self.assertEqual(odb.metadata(), {'revision': '3', 'parent': '2', 'tag': 'v1',
+                                          'tablestats': odb.get('tablestats')})
+        # filters
+        self.assertEqual(len(odb.log(since='2000-01-01')), 2)
+        self.assertEqual(len(odb.log(until='2000-01-01')), 0)
+        self.assertEqual(len(odb.log(min_size=revs[1]['size'])), 2)
+        self.assertEqual(len(odb.log(min_duration=3600)), 0)
+        self.assertEqual(len(odb.log(committer=revs[1]['committer'])), 2)
+        self.assertEqual(odb.glog(None, committer='nobody'), [])
+
+    def test_metrics(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        metrics = Metrics(os.path.join(tmpdir, 'state'))
+        odb = ODB(self.db, metrics=metrics)
+        odb.init()
+        odb.commit()
+        odb.commit()
+        odb.tag('v1', 2)
+        odb.revert()
+        odb.purge('keeptags')
+        odb.purge('keeptags', confirm=True)
+        metrics.export(odb, os.path.join(tmpdir, 'odb.prom'))
+        with open(os.path.join(tmpdir, 'odb.prom')) as f:
+            lines = f.read().splitlines()
+        db = '"%s"' % self.db
+        self.assertIn('odb_snapshots{db=%s} 1' % db, lines)
+        self.assertIn('odb_commit_duration_seconds_count{db=%s} 2' % db, lines)
+        self.assertIn('odb_commit_duration_seconds_bucket{db=%s,le="+Inf"} 2' % db, lines)
+        self.assertIn('odb_revert_duration_seconds_count{db=%s} 1' % db, lines)
+        self.assertIn('odb_purge_duration_seconds_count{db=%s} 1' % db, lines)
+        # commit x2 (statistics and clone) x2, revert x2 and drop
+        self.assertIn('odb_disconnect_retries_count{db=%s} 7' % db, lines)
+        self.assertEqual(lines[-1], '# EOF')
+        # no untagged snapshot left
+        self.assertFalse([l for l in lines if l.startswith('odb_oldest_untagged')])
+        # no concurrent observation is lost
+        threads = [threading.Thread(target=lambda: [metrics.observe('other', 'purge', 1)
+                                                    for _ in range(20)]) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.load()['other']['purge']['count'], 100)
+
+    def test_store(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        odb = ODB(self.db, store=Store(tmpdir))
+        # the restore must keep the encoding
+        settings = _recreate_with_another_encoding(odb)
+        odb.init()
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("CREATE TABLE partner (id serial PRIMARY KEY, name text)")
+            cr.execute("CREATE TABLE big (id integer REFERENCES partner, data text)")
+            cr.execute("INSERT INTO partner (name) VALUES ('foo'), ('bar')")
+            cr.execute("INSERT INTO big SELECT 1, md5(i::text) FROM generate_series(1, 10000) i")
+        odb.commit(msg='first', store=True)
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("INSERT INTO partner (name) VALUES ('baz')")
+        odb.commit(store=True)
+        odb.commit()
+        revs = odb.log()
+        self.assertEqual([r['revision'] for r in revs], [4, 3, 2, 1])
+        self.assertEqual([r.get('storage') for r in revs], [None, None, 'store', 'store'])
+        self.assertEqual(revs[3]['message'], 'first')
+        # only the modified table is stored again
+        self.assertGreater(revs[3]['stored'], revs[2]['stored'] * 10)
+        # revert from the store
+        odb.revert(1)
+        self.assertEqual((odb.revision(), odb.parent()), (4, 1))
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("SELECT name FROM partner ORDER BY id")
+            self.assertEqual(cr.fetchall(), [('foo',), ('bar',)])
+            cr.execute("SELECT count(*) FROM big")
+            self.assertEqual(cr.fetchone()[0], 10000)
+            cr.execute("INSERT INTO partner (name) VALUES ('qux') RETURNING id")
+            self.assertEqual(cr.fetchone()[0], 3)
+            self.assertRaises(Exception, cr.execute, "INSERT INTO big VALUES (99, 'x')")
+        with odb.connect('postgres') as cn, cn.cursor() as cr:
+            self.assertEqual(odb._settings(cr, self.db), settings)
+        # the stored revisions are exported with their size
+        lines = Metrics(os.path.join(tmpdir, 'metrics')).render(odb).splitlines()
+        self.assertIn('odb_snapshot_size_bytes{db="%s",revision="1"} %s'
+                      % (self.db, revs[3]['size']), lines)
+        self.assertEqual(odb.get('message'), None)
+        # tags and verify
+        odb.tag('v1', 2)
+        self.assertEqual(odb.log()[2]['tag'], 'v1')
+        odb.revert(tag='v1')
+        self.assertEqual(odb.parent(), 2)
+        self.assertEqual(odb.verify(2), {2: []})
+        # purge removes the unused chunks
+        odb.purge('keeptags', confirm=True)
+        self.assertEqual([r['revision'] for r in odb.log()], [4, 2])
+        odb.tag('v1', delete=True)
+        odb.purge('all', confirm=True)
+        self.assertEqual(os.listdir(os.path.join(tmpdir, 'revisions', self.db)), [])
+        self.assertEqual(sum(len(f) for _, _, f in os.walk(os.path.join(tmpdir, 'objects'))), 0)
+        # the garbage collection waits for the saves in progress
+        with odb.store._lock(shared=True):
+            gc = threading.Thread(target=odb.store.gc)
+            gc.start()
+            time.sleep(0.2)
+            self.assertTrue(gc.is_alive())
+        gc.join()
+
+    def test_fast_revert(self):
+        odb = ODB(self.db)
+        odb.init()
+        with odb.connect() as cn, cn.cursor() as cr:
+            if cn.server_version < 150000:
+                self.skipTest('fast revert needs PostgreSQL 15')
+            cr.execute("CREATE TABLE partner (id serial PRIMARY KEY, name text)")
+            cr.execute("CREATE TABLE line (id integer REFERENCES partner, qty integer)")
+            cr.execute("CREATE TABLE untouched (id integer)")
+            cr.execute("INSERT INTO partner (name) VALUES ('foo'), ('bar')")
+            cr.execute("INSERT INTO line VALUES (1, 1), (2, 2)")
+        odb.commit()
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("INSERT INTO partner (name) VALUES ('baz')")
+            cr.execute("DELETE FROM line WHERE id = 2")
+        self.assertEqual(odb.revert(fast=True),
+                         ['public.ir_config_parameter', 'public.line', 'public.partner'])
+        self.assertEqual((odb.revision(), odb.parent()), (2, 1))
+        # the db was fenced during the reset only
+        with odb.connect('postgres') as cn, cn.cursor() as cr:
+            cr.execute('SELECT datallowconn FROM pg_database WHERE datname=%s', (self.db,))
+            self.assertTrue(cr.fetchone()[0])
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("SELECT name FROM partner ORDER BY id")
+            self.assertEqual(cr.fetchall(), [('foo',), ('bar',)])
+            cr.execute("SELECT id, qty FROM line ORDER BY id")
+            self.assertEqual(cr.fetchall(), [(1, 1), (2, 2)])
+            cr.execute("INSERT INTO partner (name) VALUES ('qux') RETURNING id")
+            self.assertEqual(cr.fetchone()[0], 3)
+        # again, only the table modified since the last revert
+        self.assertEqual(odb.revert(fast=True), ['public.ir_config_parameter', 'public.partner'])
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("SELECT count(*) FROM partner")
+            self.assertEqual(cr.fetchone()[0], 2)
+            # a schema change needs a full clone
+            cr.execute("ALTER TABLE partner ADD COLUMN email text")
+        self.assertEqual(odb.revert(fast=True), None)
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("SELECT count(*) FROM information_schema.columns "
+                       "WHERE table_name = 'partner'")
+            self.assertEqual(cr.fetchone()[0], 2)
+            # a TRUNCATE after a full revert, which has no statistics
+            cr.execute("TRUNCATE partner, line")
+        self.assertEqual(odb.revert(fast=True),
+                         ['public.ir_config_parameter', 'public.line', 'public.partner'])
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("SELECT count(*) FROM partner")
+            self.assertEqual(cr.fetchone()[0], 2)
+        # the fast revert works after a full one, not to another parent
+        self.assertEqual(odb.revert(fast=True), ['public.ir_config_parameter'])
+        odb.commit()
+        self.assertEqual(odb.revert(1, fast=True), None)
+        # a write during the commit, after the copy, isn't part of the baseline
+        snapshot = odb.snapshot
+
+        def write_after_snapshot(*args, **kwargs):
+            stats = snapshot(*args, **kwargs)
+            with odb.connect() as cn, cn.cursor() as cr:
+                cr.execute("INSERT INTO partner (name) VALUES ('during commit')")
+            cn.close()
+            return stats
+        odb.snapshot = write_after_snapshot
+        odb.commit()
+        del odb.snapshot
+        self.assertEqual(odb.revert(fast=True), ['public.ir_config_parameter', 'public.partner'])
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("SELECT count(*) FROM partner")
+            self.assertEqual(cr.fetchone()[0], 2)
+
+    def test_background_commit(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        odb = ODB(self.db)
+        odb.init()
+        self.assertRaises(ValueError, odb.commit, background=True)
+        # only the owner can fence the db
+        role = self.db + '-guest'
+        with odb.connect('postgres') as cn, cn.cursor() as cr:
+            cr.execute('CREATE ROLE "%s" LOGIN' % role)
+        cn.close()
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute('GRANT ALL ON ir_config_parameter TO "%s"' % role)
+        cn.close()
+
+        def drop_guest():  # after the tearDown, which drops its grant with the db
+            with odb.connect('postgres') as cn, cn.cursor() as cr:
+                cr.execute('DROP ROLE "%s"' % role)
+            cn.close()
+        self.addCleanup(drop_guest)
+        guest = ODB(self.db, user=role, queue=Queue(tmpdir))
+        self.assertRaises(NotOwner, guest.commit, background=True)
+        self.assertEqual((odb.revision(), guest.queue.jobs(self.db)), (1, []))
+        # without worker, to check the queued job
+        odb.queue = Queue(tmpdir)
+        odb.queue.spawn = lambda db: None
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("CREATE TABLE partner (id serial PRIMARY KEY, name text)")
+            cr.execute("INSERT INTO partner (name) VALUES ('foo')")
+        odb.tag('v1')
+        odb.commit(msg='first', background=True)
+        # the db is fenced until the clone
+        self.assertRaises(psycopg2.OperationalError, odb.connect)
+        odb.queue.wait(self.db)
+        # the revision was assigned before
+        self.assertEqual((odb.revision(), odb.parent()), (2, 1))
+        self.assertEqual(odb.get('tag'), None)
+        self.assertEqual([(j['revision'], j['status']) for j in odb.queue.jobs(self.db)],
+                         [(1, 'done')])
+        revs = odb.log()
+        self.assertEqual([r['revision'] for r in revs], [2, 1])
+        self.assertEqual((revs[1]['message'], revs[1]['tag']), ('first', 'v1'))
+        self.assertNotIn('status', revs[1])
+        self.assertEqual(odb.verify(1), {1: []})
+        # a failure is reported in the log
+        ODB(self.db + '*2')._createdb()
+        self.assertEqual(odb.commit(background=True), 2)
+        odb.queue.wait(self.db)
+        # which isn't dropped, since another one created it
+        odb.dropdb(self.db + '*2')
+        revs = odb.log()
+        self.assertEqual([r['revision'] for r in revs], [3, 2, 1])
+        self.assertEqual(revs[1]['status'], 'failed')
+        self.assertIn('already exists', revs[1]['error'])
+        # the revert waits for the worker
+        odb.queue = Queue(tmpdir)
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("INSERT INTO partner (name) VALUES ('bar')")
+        odb.commit(background=True)
+        odb.revert(3)
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("SELECT count(*) FROM partner")
+            self.assertEqual(cr.fetchone()[0], 2)
+        # the clone is stored and compacted instead of the fenced db
+        odb.store = Store(os.path.join(tmpdir, 'store'))
+        odb.commit(store=True, compact=True, background=True)
+        odb.queue.wait(self.db)
+        revs = odb.log()
+        self.assertEqual([(r['revision'], r.get('storage')) for r in revs[:2]],
+                         [(5, None), (4, 'store')])
+        self.assertIn('size_after', revs[1])
+        with odb.connect('postgres') as cn, cn.cursor() as cr:
+            self.assertFalse(odb._exists(cr, self.db + '*4'))
+        odb.purge('all', confirm=True)
+        self.assertEqual([r['revision'] for r in odb.log()], [5])
+        self.assertEqual(odb.queue.clear(self.db), [])
+
+    def test_scheduler(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        scheduler = Scheduler(max_clones=1, max_replication_lag=60, delay=0.1)
+        odb = ODB(self.db, metrics=Metrics(os.path.join(tmpdir, 'metrics')), scheduler=scheduler)
+        odb.init()
+        # another clone holds the only slot
+        cn = odb.connect('postgres')
+        cn.autocommit = True
+        with cn.cursor() as cr:
+            self.assertEqual(scheduler.pressure(cr), None)
+            with scheduler.slot(cr) as slot:
+                self.assertEqual(slot, 1)
+                commit = threading.Thread(target=odb.commit)
+                commit.start()
+                time.sleep(1)
+                self.assertTrue(commit.is_alive())
+            commit.join()
+        cn.close()
+        revs = odb.log()
+        self.assertEqual([r['revision'] for r in revs], [2, 1])
+        self.assertGreaterEqual(revs[1]['clone_wait'], 1)
+        self.assertLess(revs[1]['duration'], revs[1]['clone_wait'])
+        odb.revert()
+        self.assertEqual(odb.metrics.load()[self.db]['clone_wait']['count'], 2)
+
     def tearDown(self):
         """ cleanup
         """
@@ -337,3 +727,63 @@ class TestCommit(unittest.TestCase):
         odb = ODB(self.db)
         odb.purge('all', confirm=True)
         odb.dropdb()
+
+
+class TestTransfer(unittest.TestCase):
+    """ the remote cluster can be set with ODB_TEST_REMOTE_HOST and
+    ODB_TEST_REMOTE_PORT, otherwise another db of the same cluster is used
+    """
+    def setUp(self):
+        db = self.db = 'testodb-' + time.strftime('%Y%m%d%H%M%S')
+        ODB(db)._createdb()
+        self.remote = ODB(db + '-remote',
+                          host=os.environ.get('ODB_TEST_REMOTE_HOST'),
+                          port=os.environ.get('ODB_TEST_REMOTE_PORT'))
+        self.remote._createdb()
+
+    def test_push_pull(self):
+        odb, remote = ODB(self.db), self.remote
+        encoding = _recreate_with_another_encoding(odb)['encoding']
+        odb.init()
+        remote.init()
+        with odb.connect() as cn, cn.cursor() as cr:
+            cr.execute("CREATE TABLE partner (id serial PRIMARY KEY, name text)")
+            cr.execute("INSERT INTO partner (name) VALUES ('foo'), ('bar')")
+        odb.commit(msg='two partners')
+        odb.tag('v1', 1)
+        odb.commit()
+        # push the parent by default
+        self.assertEqual(odb.push(remote), 2)
+        # push a tag
+        self.assertEqual(odb.push(remote, tag='v1'), 1)
+        self.assertRaises(TransferError, odb.push, remote, 1)
+        self.assertRaises(NoTemplate, odb.push, remote, tag='v2')
+        # the revisions and their metadata are available on the remote
+        revs = remote.log()
+        # and the remote commits after them
+        self.assertEqual([r['revision'] for r in revs], [3, 2, 1])
+        self.assertEqual(revs[2]['db'], remote.db + '*1')
+        self.assertEqual(revs[2]['tag'], 'v1')
+        self.assertEqual(revs[2]['message'], 'two partners')
+        with remote.connect('postgres') as cn, cn.cursor() as cr:
+            self.assertEqual(remote._settings(cr, remote.db + '*1')['encoding'], encoding)
+        remote.revert(tag='v1')
+        with remote.connect() as cn, cn.cursor() as cr:
+            cr.execute("SELECT name FROM partner ORDER BY id")
+            self.assertEqual(cr.fetchall(), [('foo',), ('bar',)])
+            cr.execute("INSERT INTO partner (name) VALUES ('baz') RETURNING id")
+            self.assertEqual(cr.fetchone()[0], 3)
+        remote.commit()
+        # pull back
+        odb.purge('all', confirm=True)
+        self.assertEqual(odb.pull(remote, 1), 1)
+        self.assertEqual(odb.log()[1]['tag'], 'v1')
+        self.assertEqual(odb.pull(remote, 3), 3)
+        self.assertEqual(odb.revision(), 4)
+        odb.commit()
+        self.assertEqual([r['revision'] for r in odb.log()], [5, 4, 3, 1])
+
+    def tearDown(self):
+        for odb in ODB(self.db), self.remote:
+            odb.purge('all', confirm=True)
+            odb.dropdb()
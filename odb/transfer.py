@@ -0,0 +1,168 @@
+""" stream revisions between two PostgreSQL clusters
+
+The schema is piped from ``pg_dump`` to ``pg_restore`` in the compressed
+custom format, once before the data and once after it for the indexes and
+constraints. The data is copied in between by ``jobs`` pairs of connections
+sharing an exported snapshot of the source, each table through a compressed
+temporary file, like the store does.
+"""
+import os
+import subprocess
+import tempfile
+import threading
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from .odb import TransferError, TagExists
+
+BUFSIZE = 1024 * 1024
+
+
+def _env(odb):
+    """ environment of the pg tools, to avoid showing the password in ps
+    """
+    env = dict(os.environ)
+    if odb.password:
+        env['PGPASSWORD'] = odb.password
+    return env
+
+
+def _connection_string(odb, db):
+    return odb._get_connection_string(db, password='')
+
+
+class _Spool(object):
+    """ temporary file compressing what is written, then decompressing it
+    when it is read after rewind()
+    """
+    def __init__(self, compress):
+        self.file = tempfile.TemporaryFile()
+        self.compressor = zlib.compressobj(compress)
+        self.decompressor = zlib.decompressobj()
+        self.buffer = b''
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.file.write(self.compressor.compress(data))
+
+    def rewind(self):
+        self.file.write(self.compressor.flush())
+        self.file.seek(0)
+
+    def read(self, size=BUFSIZE):
+        while len(self.buffer) < size:
+            data = self.file.read(BUFSIZE)
+            if not data:
+                self.buffer += self.decompressor.flush()
+                break
+            self.buffer += self.decompressor.decompress(data)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+    def close(self):
+        self.file.close()
+
+
+def _pipe(source, sourcedb, target, targetdb, args, compress):
+    """ pipe a pg_dump of the source to a pg_restore on the target
+    """
+    dump = subprocess.Popen(
+        ['pg_dump', '--format=custom', '--compress=%d' % compress,
+         '--dbname=%s' % _connection_string(source, sourcedb)] + args,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=_env(source))
+    restore = subprocess.Popen(
+        ['pg_restore', '--no-owner', '--no-privileges', '--exit-on-error',
+         '--dbname=%s' % _connection_string(target, targetdb)],
+        stdin=dump.stdout, stderr=subprocess.PIPE, env=_env(target))
+    dump.stdout.close()  # let pg_dump receive a SIGPIPE if pg_restore dies
+    restore_err = restore.communicate()[1]
+    dump_err = dump.stderr.read()
+    dump.wait()
+    if dump.returncode or restore.returncode:
+        raise TransferError((dump_err + restore_err).decode('utf-8', 'replace').strip())
+
+
+def transfer(source, target, revision, jobs=4, compress=6):
+    """ copy the ``revision`` snapshot of the ``source`` ODB
+    into the same revision of the ``target`` ODB
+    """
+    sourcedb = '*'.join([source.db, str(revision)])
+    targetdb = '*'.join([target.db, str(revision)])
+    with source.connect('postgres') as cn, cn.cursor() as cr:
+        if not source._exists(cr, sourcedb):
+            raise TransferError('The source revision does not exist')
+    with source.connect(sourcedb) as cn, cn.cursor() as cr:
+        tag = source.get('tag', cr)
+        # the owner may not exist on the target
+        settings = dict(source._settings(cr, sourcedb), owner=None)
+    cn = target.connect('postgres')
+    cn.autocommit = True
+    with cn.cursor() as cr:
+        if target._exists(cr, targetdb):
+            raise TransferError('The target revision already exists')
+        if tag and target._exists(cr, target.db) and tag in [r['tag'] for r in target.tag()]:
+            raise TagExists('This tag already exists')
+        target._create_empty(cr, targetdb, settings)
+        working = target._exists(cr, target.db)
+
+    cn = source.connect(sourcedb)
+    cn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+    local, connections = threading.local(), []
+
+    def copy(table):
+        """ copy the data of a table with the connections of this thread
+        """
+        if not hasattr(local, 'source'):
+            local.source, local.target = source.connect(sourcedb), target.connect(targetdb)
+            connections.extend([local.source, local.target])
+            local.source.set_session(isolation_level='REPEATABLE READ', readonly=True)
+            local.target.autocommit = True
+            with local.source.cursor() as cr:
+                cr.execute('SET TRANSACTION SNAPSHOT %s', (snapshot,))
+        spool = _Spool(compress)
+        try:
+            with local.source.cursor() as cr:
+                cr.copy_expert('COPY "%s"."%s" TO STDOUT' % table, spool)
+            spool.rewind()
+            with local.target.cursor() as cr:
+                cr.copy_expert('COPY "%s"."%s" FROM STDIN' % table, spool)
+        finally:
+            spool.close()
+
+    try:
+        with cn.cursor() as cr:
+            cr.execute('SELECT pg_export_snapshot()')
+            snapshot = cr.fetchone()[0]
+            tables = source._tables(cr, ('r',))
+            sequences = []
+            for schema, name in source._tables(cr, ('S',)):
+                cr.execute('SELECT last_value, is_called FROM "%s"."%s"' % (schema, name))
+                sequences.append(('"%s"."%s"' % (schema, name),) + cr.fetchone())
+        _pipe(source, sourcedb, target, targetdb,
+              ['--section=pre-data', '--snapshot=%s' % snapshot], compress)
+        pool = ThreadPool(max(jobs, 1))
+        try:
+            pool.map(copy, tables, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+            for connection in connections:
+                connection.close()
+        with target.connect(targetdb) as tcn, tcn.cursor() as cr:
+            for sequence, value, called in sequences:
+                cr.execute('SELECT setval(%s, %s, %s)', (sequence, value, called))
+        tcn.close()
+        _pipe(source, sourcedb, target, targetdb,
+              ['--section=post-data', '--snapshot=%s' % snapshot], compress)
+    except Exception:
+        cn.close()
+        target.dropdb(targetdb)
+        raise
+    cn.close()
+    # the next commit of the target must not clone over the copied revision
+    if working:
+        with target.connect() as cn, cn.cursor() as cr:
+            current = target.get('revision', cr)
+            if current is not None and int(current) <= int(revision):
+                target.set('revision', int(revision) + 1, cr)